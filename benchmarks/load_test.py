@@ -0,0 +1,153 @@
+# Offline load test for the feed pipeline: get_rss_feed -> get_latest_posts -> delivery.
+# Runs against a local mock of Nitter and the status API (in a separate process, so it doesn't
+# share the bot's CPU) and delivers to fake channels that record what they are sent.
+# Run from the repository root: python benchmarks/load_test.py --sizes 100 1000 10000
+import os
+import sys
+import time
+import asyncio
+import argparse
+import resource
+import multiprocessing
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+from mock_nitter import STATUS_API_PATH, run_server
+
+# Channel that records messages instead of sending them to Discord
+class FakeChannel:
+    sent = []
+
+    def __init__(self, channel_id: int, send_latency: float):
+        self.channel_id = channel_id
+        self.send_latency = send_latency
+
+    async def send(self, content: str):
+        if self.send_latency > 0:
+            await asyncio.sleep(self.send_latency)
+        FakeChannel.sent.append((self.channel_id, content))
+
+# Time spent parsing, measured inside the parser so it leaves out waiting for a parse process
+def get_parse_seconds():
+    histogram = main.metrics.get_histogram('nitter_bot_parse_seconds')
+    return histogram['sum'] if histogram is not None else 0.0
+
+# Peak memory of this process plus the parse pool processes, where feeds are parsed. RUSAGE_CHILDREN
+# only covers children that have exited, so the peaks of running pool processes are read from /proc.
+def peak_memory_mb():
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    processes = getattr(main.parse_executor, '_processes', None) or {}
+    for pid in list(processes):
+        try:
+            with open(f'/proc/{pid}/status') as file:
+                peak_kb += next(int(line.split()[1]) for line in file if line.startswith('VmHWM:'))
+        except (OSError, StopIteration):
+            pass
+    return peak_kb / 1024
+
+async def wait_for_server(session, url: str):
+    for attempt in range(100):
+        try:
+            async with session.get(url) as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.1)
+    raise RuntimeError(f'Mock server did not start: {url}')
+
+async def get_server_requests(session, control_url: str):
+    async with session.get(f'{control_url}/mock/stats') as response:
+        return (await response.json())['requests']
+
+# Replace the feeds with size feeds, subscribed channels_per_user times each
+def load_feeds(size: int, channels_per_user: int):
+    main.feed_store.connection.execute('DELETE FROM feeds')
+    main.feed_store.connection.commit()
+    main.feed_scheduler = main.FeedScheduler()
+    main.feed_cache = main.FeedCache()
+    users = max(size // channels_per_user, 1)
+    feeds = [{'guild_id': index % 10, 'name': f'user{index % users}', 'channel_id': index, 'last_checked': -1, 'enabled': True} for index in range(size)]
+    main.feed_store.add_feeds(feeds)
+    main.feed_index = main.SubscriptionIndex(main.feed_store)
+    return main.feed_index.get_all_feeds()
+
+async def run_size(size: int, args, session, control_url: str):
+    feeds = load_feeds(size, args.channels_per_user)
+    results = []
+    for cycle in range(args.cycles + 1):
+        if cycle > 0:
+            async with session.post(f'{control_url}/mock/advance') as response:
+                await response.read()
+            # Simulate a poll interval passing so the fetch cache doesn't answer from memory
+            for entry in main.feed_cache.latest.values():
+                entry['fetched'] = 0
+        parse_seconds = get_parse_seconds()
+        FakeChannel.sent = []
+        requests_before = await get_server_requests(session, control_url)
+        start_time = time.perf_counter()
+        successful_updates, failed_updates = await main.poll_feeds(feeds, main.http_session)
+        fetch_seconds = main.last_poll_cycle['fetch_seconds']
+        while main.delivery_queue.workers:
+            await asyncio.sleep(0.01)
+        wall_seconds = time.perf_counter() - start_time
+        requests = await get_server_requests(session, control_url) - requests_before
+        results.append({
+            'size': size,
+            'cycle': 'first' if cycle == 0 else str(cycle),
+            'wall_seconds': wall_seconds,
+            'requests_per_second': requests / fetch_seconds if fetch_seconds > 0 else 0,
+            'requests': requests,
+            'parse_ms': (get_parse_seconds() - parse_seconds) * 1000,
+            'posts': sum(item['posts'] for item in successful_updates),
+            'messages': len(FakeChannel.sent),
+            'failed': len(failed_updates),
+            'peak_memory_mb': peak_memory_mb(),
+        })
+    return results
+
+def print_results(results):
+    print(f"\n{'feeds':>7} {'cycle':>6} {'wall s':>8} {'req/s':>8} {'requests':>9} {'parse ms':>9} {'posts':>6} {'msgs':>6} {'failed':>7} {'peak MB':>8}")
+    for row in results:
+        print(f"{row['size']:>7} {row['cycle']:>6} {row['wall_seconds']:>8.2f} {row['requests_per_second']:>8.0f} {row['requests']:>9} {row['parse_ms']:>9.1f} {row['posts']:>6} {row['messages']:>6} {row['failed']:>7} {row['peak_memory_mb']:>8.1f}")
+
+async def run_load_test(args):
+    ports = [args.port + index for index in range(args.instances)]
+    control_url = f'http://127.0.0.1:{ports[0]}'
+    server = multiprocessing.Process(target = run_server, args = (ports, args.latency, args.error_rate, args.new_post_rate), daemon = True)
+    server.start()
+    try:
+        # Keep the load test away from the real feeds database
+        main.open_storage(':memory:')
+        main.INSTANCE_URL_SCHEME = 'http'
+        main.INSTANCES_API_URL = f'{control_url}{STATUS_API_PATH}'
+        main.bot.get_partial_messageable = lambda channel_id: FakeChannel(channel_id, args.send_latency)
+        main.http_session = main.create_http_session()
+        async with aiohttp.ClientSession() as session:
+            await wait_for_server(session, main.INSTANCES_API_URL)
+            await main.refresh_instance_pool(main.http_session)
+            results = []
+            for size in args.sizes:
+                results += await run_size(size, args, session, control_url)
+        await main.http_session.close()
+        print_results(results)
+    finally:
+        server.terminate()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = 'Load test the feed pipeline against a mock Nitter server')
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [100, 1000, 10000], help = 'Numbers of feeds to test')
+    parser.add_argument('--cycles', type = int, default = 2, help = 'Poll cycles after the first one, per size')
+    parser.add_argument('--channels-per-user', type = int, default = 1, help = 'Channels following each username')
+    parser.add_argument('--instances', type = int, default = 3, help = 'Mock Nitter instances to serve')
+    parser.add_argument('--latency', type = float, default = 0.05, help = 'Mock instance response latency in seconds')
+    parser.add_argument('--error-rate', type = float, default = 0.0, help = 'Fraction of feed requests answered with 502')
+    parser.add_argument('--new-post-rate', type = float, default = 0.1, help = 'Chance of a user posting between cycles')
+    parser.add_argument('--send-latency', type = float, default = 0.0, help = 'Fake Discord send latency in seconds')
+    parser.add_argument('--port', type = int, default = 8780, help = 'First port for the mock instances')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    asyncio.run(run_load_test(parse_args()))
@@ -0,0 +1,118 @@
+# Local stand-in for Nitter instances and the Nitter status API, used by the load test.
+# Serves synthetic RSS feeds for any username, with configurable latency and error rate.
+import time
+import random
+import asyncio
+import email.utils
+from aiohttp import web
+
+STATUS_API_PATH = '/api/v1/instances'
+POSTS_PER_FEED = 20 # Nitter returns 20 posts per page
+
+class MockNitter:
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, new_post_rate: float = 0.1, seed: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.new_post_rate = new_post_rate
+        self.random = random.Random(seed)
+        self.ports = []
+        self.feeds = {}
+        self.requests = 0
+        self.errors = 0
+
+    # Posts of a user, newest first, created on first request
+    def get_posts(self, name: str):
+        if name not in self.feeds:
+            now = int(time.time())
+            status_id = 1743727226929721537 + self.random.randrange(10**15)
+            posts = []
+            for index in range(POSTS_PER_FEED):
+                posts.append((status_id, now - 3600 * (index + 1)))
+                status_id -= self.random.randrange(10**14, 10**15)
+            self.feeds[name] = {'posts': posts, 'body': None}
+        return self.feeds[name]
+
+    # Move time forward: each user gets a new post with probability new_post_rate
+    def advance(self):
+        now = int(time.time()) + 1
+        for feed in self.feeds.values():
+            if self.random.random() < self.new_post_rate:
+                status_id = feed['posts'][0][0] + self.random.randrange(10**14, 10**15)
+                feed['posts'] = [(status_id, now)] + feed['posts'][:POSTS_PER_FEED - 1]
+                feed['body'] = None
+
+    def render_feed(self, domain: str, name: str):
+        feed = self.get_posts(name)
+        if feed['body'] is not None:
+            return feed['body']
+        lines = [
+            '<?xml version="1.0" encoding="UTF-8"?>',
+            '<rss xmlns:atom="http://www.w3.org/2005/Atom" xmlns:dc="http://purl.org/dc/elements/1.1/" version="2.0">',
+            '  <channel>',
+            f'    <atom:link href="http://{domain}/{name}/rss" rel="self" type="application/rss+xml" />',
+            f'    <title>{name} / @{name}</title>',
+            f'    <link>http://{domain}/{name}</link>',
+            f'    <description>Twitter feed for: @{name}. Generated by {domain}</description>',
+            '    <language>en-us</language>',
+            '    <ttl>40</ttl>',
+        ]
+        for status_id, timestamp in feed['posts']:
+            lines += [
+                '    <item>',
+                f'      <title>Post {status_id} from @{name} with some text to make it a realistic length for a feed entry</title>',
+                f'      <dc:creator>@{name}</dc:creator>',
+                f'      <description><![CDATA[<p>Post {status_id} from @{name} with some text to make it a realistic length for a feed entry</p>]]></description>',
+                f'      <pubDate>{email.utils.formatdate(timestamp, usegmt = True)}</pubDate>',
+                f'      <guid>http://{domain}/{name}/status/{status_id}#m</guid>',
+                f'      <link>http://{domain}/{name}/status/{status_id}#m</link>',
+                '    </item>',
+            ]
+        lines += ['  </channel>', '</rss>', '']
+        # Every port serves the same links, as the bot swaps the host for display anyway
+        feed['body'] = '\n'.join(lines).encode()
+        return feed['body']
+
+    async def handle_feed(self, request):
+        self.requests += 1
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        if self.random.random() < self.error_rate:
+            self.errors += 1
+            return web.Response(status = 502)
+        body = self.render_feed(request.host, request.match_info['name'])
+        return web.Response(body = body, content_type = 'application/rss+xml')
+
+    async def handle_status_api(self, request):
+        hosts = [{'domain': f'127.0.0.1:{port}', 'healthy': True, 'rss': True, 'ping_avg': 10 + index} for index, port in enumerate(self.ports)]
+        return web.json_response({'hosts': hosts})
+
+    async def handle_advance(self, request):
+        self.advance()
+        return web.json_response({'feeds': len(self.feeds)})
+
+    async def handle_stats(self, request):
+        return web.json_response({'requests': self.requests, 'errors': self.errors})
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_get(STATUS_API_PATH, self.handle_status_api)
+        app.router.add_post('/mock/advance', self.handle_advance)
+        app.router.add_get('/mock/stats', self.handle_stats)
+        app.router.add_get('/{name}/rss', self.handle_feed)
+        return app
+
+    # Serve the app on each port. Each port acts as a separate Nitter instance.
+    async def start(self, ports: list):
+        self.ports = ports
+        runner = web.AppRunner(self.create_app(), access_log = None)
+        await runner.setup()
+        for port in ports:
+            await web.TCPSite(runner, '127.0.0.1', port).start()
+        return runner
+
+def run_server(ports: list, latency: float, error_rate: float, new_post_rate: float):
+    async def serve():
+        mock = MockNitter(latency, error_rate, new_post_rate)
+        await mock.start(ports)
+        await asyncio.Event().wait()
+    asyncio.run(serve())
@@ -0,0 +1,38 @@
+# Micro-benchmark comparing feedparser with the fast RSS parser on Nitter RSS fixtures.
+# Run from the repository root: python benchmarks/parse_benchmark.py
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rss_parser
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+REPEAT = 5
+NUMBER = 50
+
+def best_time(function):
+    return min(timeit.repeat(function, repeat = REPEAT, number = NUMBER)) / NUMBER
+
+def run_benchmark():
+    print(f"{'fixture':<20} {'parser':<32} {'ms/parse':>10} {'speedup':>8}")
+    for file_name in sorted(os.listdir(FIXTURES_DIR)):
+        with open(os.path.join(FIXTURES_DIR, file_name), 'rb') as file:
+            body = file.read()
+        # A typical poll: only the newest post is new, so parsing stops at the second post
+        title, entries, complete = rss_parser.parse_rss_fast(body)
+        stop_ids = frozenset(post_id for timestamp, link, post_id in entries[1:])
+        cases = [
+            ('feedparser', lambda: rss_parser.parse_rss_feedparser(body)),
+            ('fast parser, full feed', lambda: rss_parser.parse_rss_fast(body)),
+            ('fast parser, stop at seen post', lambda: rss_parser.parse_rss_fast(body, stop_ids)),
+        ]
+        baseline = None
+        for parser_name, function in cases:
+            seconds = best_time(function)
+            baseline = baseline or seconds
+            print(f'{file_name:<20} {parser_name:<32} {seconds * 1000:>10.3f} {baseline / seconds:>7.1f}x')
+
+if __name__ == '__main__':
+    run_benchmark()
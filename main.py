@@ -1,19 +1,37 @@
 import os
 import time
-import pytz
 import discord
 import logging
-import feedparser
 import aiohttp
 import asyncio
 import typing
-from time import mktime
-from typing import List
-from pytz import timezone
-from datetime import datetime
+import sqlite3
+import abc
+import random
+import re
+import hashlib
+import io
+import collections
+import heapq
+import zlib
+import bisect
+import contextlib
+import sys
+import subprocess
+import atexit
+import concurrent.futures
+import multiprocessing
+import json
+import csv
+import signal
+from aiohttp import web
+import xml.etree.ElementTree as ElementTree
+from typing import List, NamedTuple, Optional
+from urllib.parse import urlsplit, urlunsplit
 from dotenv import load_dotenv
 from discord import app_commands
-from tinydb import TinyDB, Query
+from tinydb import TinyDB
+from rss_parser import parse_rss_feed
 from discord.ext import tasks
 
 # Loads the .env file that resides on the same level as the script.
@@ -23,52 +41,1083 @@ DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
 #GUILD_ID = os.getenv('GUILD_ID') # For testing. Speed up testing by only syncing commands to test server.
 
 INSTANCES_API_URL = 'https://status.d420.de/api/v1/instances'
+INSTANCE_URL_SCHEME = 'https' # Scheme used to reach Nitter instances
 DISPLAY_DOMAIN = 'twitter.com' #'nitter.poast.org'
-PUBLISHED_TIMEZONE = pytz.timezone('UTC') # Nitter RSS feed dates are in UTC timezone
 REFERENCE_FEED = 'x' # Choose an account that is likely to stay up
 TOKEN_SEPARATOR = '-' # Choose a value that is not part of a username (not 0-9, a-z, _)
-FEED_REFRESH_INTERVAL_MINUTES = 15
+AUTOCOMPLETE_MAX_CHOICES = 25 # Discord limit on autocomplete choices
+IMPORT_MAX_FEEDS = 1000 # Feeds accepted in one /import-feeds file
+IMPORT_MAX_FILE_BYTES = 1024 * 1024
+USERNAME_PATTERN = re.compile(r'[A-Za-z0-9_]{1,15}') # Twitter usernames
+STATUS_ID_BYTES_PATTERN = re.compile(rb'/status/(\d+)') # Status ID in a raw feed body
+FEED_REFRESH_INTERVAL_MINUTES = 15 # Starting poll interval for a feed, adapted to how often the account posts
+FEED_MIN_INTERVAL_MINUTES = 5
+FEED_MAX_INTERVAL_MINUTES = 180
+SCHEDULER_TICK_SECONDS = 30 # How often the scheduler checks for feeds that are due
+FEED_FETCH_CONCURRENCY = int(os.getenv('FEED_FETCH_CONCURRENCY', 20)) # Maximum number of feeds fetched at the same time
+FEED_FETCH_PER_HOST_LIMIT = int(os.getenv('FEED_FETCH_PER_HOST_LIMIT', 10)) # Maximum open connections to a single instance
+HTTP_TIMEOUT_SECONDS = 30 # Total time allowed for one request
+HTTP_CONNECT_TIMEOUT_SECONDS = 10
+HTTP_KEEPALIVE_SECONDS = 60 # How long idle connections are kept open for reuse
+HTTP_DNS_CACHE_SECONDS = 300
+HTTP_COMPRESSION = os.getenv('HTTP_COMPRESSION', 'true').lower() == 'true' # Ask instances for gzip/deflate responses
+INSTANCE_POOL_SIZE = int(os.getenv('INSTANCE_POOL_SIZE', 3)) # Number of healthy instances to spread fetches across
+INSTANCE_REFRESH_INTERVAL_MINUTES = 30 # How often instances are re-probed in the background
+INSTANCE_RETRY_SECONDS = 15 # First retry delay while there are no instances, doubled on each failure
+INSTANCE_SCORE_SMOOTHING = 0.2 # Weight of the newest measurement in the moving averages used for scoring
+PARSE_EXECUTOR = os.getenv('PARSE_EXECUTOR', 'process') # Where feeds are parsed: 'process' pool, 'thread' pool or 'inline' on the event loop
+PARSE_WORKERS = int(os.getenv('PARSE_WORKERS', 0)) or None # Pool size per process, defaults to the number of CPUs shared between the poll workers
+FEED_CACHE_TTL_SECONDS = 60 # Fetches younger than this are reused instead of requesting the feed again
+SEEN_IDS_LIMIT = 100 # Status IDs remembered per subscription (Nitter feeds have 20 posts)
+DELIVERY_BATCH_SIZE = 5 # Maximum posts combined into one message (Discord embeds up to 5 links per message)
+DELIVERY_RATE_LIMIT = 5 # Messages sent to one channel per DELIVERY_RATE_PERIOD seconds
+DELIVERY_RATE_PERIOD = 5
+DELIVERY_MAX_ATTEMPTS = 4 # Attempts at sending a message when Discord has a server error or times out
+DELIVERY_RETRY_SECONDS = 2 # First retry delay, doubled on each attempt
+DELIVERY_DRAIN_SECONDS = 10 # How long shutdown waits for queued posts to be sent
+MESSAGE_MAX_LENGTH = 2000 # Discord message length limit
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9108)) # Port for the Prometheus metrics endpoint, 0 to disable
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+FEEDS_DB_PATH = os.getenv('FEEDS_DB_PATH', 'feeds.db')
+STATE_SNAPSHOT_PATH = os.getenv('STATE_SNAPSHOT_PATH', 'state.json') # Instance ranking and poll schedule saved at shutdown
+COMMAND_SYNC_CONCURRENCY = 5 # Guilds whose slash commands are synced at the same time
+POLL_WORKERS = int(os.getenv('POLL_WORKERS', 0)) # Number of separate poll worker processes, 0 to poll in the bot process
+POLL_WORKER_HEARTBEAT_SECONDS = 10 # How often poll workers record that they are alive
+POLL_WORKER_TIMEOUT_SECONDS = SCHEDULER_TICK_SECONDS * 4 # Workers without a heartbeat for this long are considered dead
 ERROR_MSG = 'Oops, something went wrong!' # Generic error message
 
 # Use logging handler
-handler = logging.FileHandler(filename = 'discord.log', encoding = 'utf-8', mode = 'w')
+# The file is only opened on the first log record, so importing this module doesn't truncate it
+handler = logging.FileHandler(filename = 'discord.log', encoding = 'utf-8', mode = 'w', delay = True)
+logger = logging.getLogger('nitter_bot')
 
-# Load database from file
-feeds_db = TinyDB('feeds.json')
-instance_db = TinyDB('instance.json')
-#config_db = TinyDB('config.json') # not yet implemented
+# Counters, gauges and histograms for the polling loop, rendered in the Prometheus text format
+class Metrics:
+    HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
 
-# Current Nitter instance
-instance_domain = ''
+    def __init__(self):
+        self.counters = collections.defaultdict(float)
+        self.gauges = {}
+        self.histograms = {}
+
+    def increment(self, name: str, value: float = 1, **labels):
+        self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        if key not in self.histograms:
+            self.histograms[key] = {'buckets': [0] * len(self.HISTOGRAM_BUCKETS), 'sum': 0.0, 'count': 0}
+        histogram = self.histograms[key]
+        for index, bound in enumerate(self.HISTOGRAM_BUCKETS):
+            if value <= bound:
+                histogram['buckets'][index] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+    # Time a stage of the polling loop (fetch, parse, db_update, send)
+    @contextlib.contextmanager
+    def time_stage(self, stage: str):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('nitter_bot_stage_seconds', time.perf_counter() - start_time, stage = stage)
+
+    def get_counter(self, name: str, **labels):
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    # Values of a counter by the value of one of its labels
+    def get_counters_by_label(self, name: str, label: str):
+        values = collections.defaultdict(float)
+        for (counter_name, labels), value in self.counters.items():
+            if counter_name == name:
+                values[dict(labels).get(label, '')] += value
+        return values
+
+    def get_histogram(self, name: str, **labels):
+        return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+    def render(self):
+        def format_labels(labels, extra = ()):
+            labels = list(labels) + list(extra)
+            if labels == []:
+                return ''
+            return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f'{name}{format_labels(labels)} {value}')
+        for (name, labels), value in sorted(self.gauges.items()):
+            lines.append(f'{name}{format_labels(labels)} {value}')
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            for bound, count in zip(self.HISTOGRAM_BUCKETS, histogram['buckets']):
+                lines.append(f"{name}_bucket{format_labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{name}_bucket{format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram['sum']}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+async def handle_metrics_request(request):
+    metrics.set_gauge('nitter_bot_delivery_queue_depth', delivery_queue.depth())
+    return web.Response(text = metrics.render(), content_type = 'text/plain')
+
+# Serve metrics on a local port for Prometheus to scrape
+async def start_metrics_server():
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics_request)
+    runner = web.AppRunner(app, access_log = None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logger.info('Serving metrics on http://%s:%s/metrics', METRICS_HOST, METRICS_PORT)
+    return runner
+
+# Storage backend for feeds and the current instance.
+# Feeds are returned as dicts with the keys guild_id, name, channel_id, last_checked, seen_ids and enabled.
+# seen_ids holds the status IDs of recently seen posts, oldest first, as the keys of a dict so it
+# keeps its order and checks membership in constant time.
+class FeedStore(abc.ABC):
+    @abc.abstractmethod
+    def get_feed(self, name: str, channel_id: int):
+        pass
+
+    @abc.abstractmethod
+    def get_guild_feeds(self, guild_id: int):
+        pass
+
+    @abc.abstractmethod
+    def get_all_feeds(self):
+        pass
+
+    @abc.abstractmethod
+    def count_feeds(self):
+        pass
+
+    @abc.abstractmethod
+    def add_feed(self, guild_id: int, name: str, channel_id: int, last_checked: int = -1, enabled: bool = True):
+        pass
+
+    # Insert several feeds in one transaction, skipping ones that already exist. Returns the number inserted.
+    @abc.abstractmethod
+    def add_feeds(self, feeds: list):
+        pass
+
+    @abc.abstractmethod
+    def remove_feed(self, name: str, channel_id: int):
+        pass
+
+    @abc.abstractmethod
+    def update_feed(self, name: str, channel_id: int, fields: dict):
+        pass
+
+    # Poll state changes are buffered and written together by flush(), once per poll cycle
+    @abc.abstractmethod
+    def queue_poll_state(self, name: str, channel_id: int, last_checked: int, seen_ids: dict):
+        pass
+
+    @abc.abstractmethod
+    def flush(self):
+        pass
+
+    # Instance domains, best first
+    @abc.abstractmethod
+    def get_instances(self):
+        pass
+
+    @abc.abstractmethod
+    def set_instances(self, domains: list):
+        pass
+
+    # Number that changes whenever another connection or process changes the feeds or instances
+    @abc.abstractmethod
+    def get_data_version(self):
+        pass
+
+# Storage for coordination state of the bot itself: poll worker heartbeats and statistics, refresh
+# requests and the slash commands last synced to each guild.
+class BotStateStore(abc.ABC):
+    # Record that a poll worker is alive
+    @abc.abstractmethod
+    def heartbeat(self, worker_id: str):
+        pass
+
+    # IDs of poll workers with a heartbeat in the last timeout seconds, sorted
+    @abc.abstractmethod
+    def get_live_workers(self, timeout: float):
+        pass
+
+    # Hash of the slash commands last synced to each guild, by guild ID
+    @abc.abstractmethod
+    def get_command_hashes(self):
+        pass
+
+    @abc.abstractmethod
+    def set_command_hash(self, guild_id: int, command_hash: str):
+        pass
+
+    # Usernames to poll right away, requested by the bot process for the poll worker that owns them
+    @abc.abstractmethod
+    def request_refresh(self, names: list):
+        pass
+
+    @abc.abstractmethod
+    def get_refresh_requests(self):
+        pass
+
+    @abc.abstractmethod
+    def clear_refresh_requests(self, names: list):
+        pass
+
+    # Polling statistics of a poll worker, for /stats in the bot process
+    @abc.abstractmethod
+    def set_poll_summary(self, worker_id: str, summary: dict):
+        pass
+
+    # Summaries written in the last timeout seconds, by worker ID
+    @abc.abstractmethod
+    def get_poll_summaries(self, timeout: float):
+        pass
+
+# Both stores on one SQLite connection. Bot state is kept in a second database file attached as
+# 'state', so heartbeats and refresh requests don't change the data version of the feeds database
+# and make every process reload its subscriptions. WAL mode lets the bot and poll worker processes
+# read while one of them writes.
+class SQLiteStore(FeedStore, BotStateStore):
+    FEED_COLUMNS = ('guild_id', 'name', 'channel_id', 'last_checked', 'enabled')
+
+    def __init__(self, path: str, state_path: str):
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('ATTACH DATABASE ? AS state', (state_path,))
+        for schema in ('main', 'state'):
+            self.connection.execute(f'PRAGMA {schema}.journal_mode = WAL')
+            self.connection.execute(f'PRAGMA {schema}.synchronous = NORMAL')
+        with self.connection:
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS feeds (
+                id INTEGER PRIMARY KEY,
+                guild_id INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                channel_id INTEGER NOT NULL,
+                last_checked INTEGER NOT NULL DEFAULT -1,
+                enabled INTEGER NOT NULL DEFAULT 1,
+                seen_ids TEXT NOT NULL DEFAULT ''
+            )""")
+            # Databases created before seen post IDs were stored
+            columns = [row['name'] for row in self.connection.execute('PRAGMA table_info(feeds)')]
+            if 'seen_ids' not in columns:
+                self.connection.execute("ALTER TABLE feeds ADD COLUMN seen_ids TEXT NOT NULL DEFAULT ''")
+            self.connection.execute('CREATE INDEX IF NOT EXISTS feeds_guild_id ON feeds (guild_id)')
+            self.connection.execute('CREATE UNIQUE INDEX IF NOT EXISTS feeds_name_channel_id ON feeds (name, channel_id)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS instances (domain TEXT PRIMARY KEY, position INTEGER NOT NULL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS state.poll_workers (worker_id TEXT PRIMARY KEY, heartbeat REAL NOT NULL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS state.command_syncs (guild_id INTEGER PRIMARY KEY, hash TEXT NOT NULL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS state.refresh_requests (name TEXT PRIMARY KEY)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS state.poll_summaries (worker_id TEXT PRIMARY KEY, updated REAL NOT NULL, summary TEXT NOT NULL)')
+        self.pending_poll_state = {}
+
+    # seen_ids is stored as space separated status IDs
+    def row_to_feed(self, row):
+        feed_data = {column: row[column] for column in self.FEED_COLUMNS}
+        feed_data['enabled'] = bool(feed_data['enabled'])
+        feed_data['seen_ids'] = dict.fromkeys(row['seen_ids'].split())
+        return feed_data
+
+    def get_feed(self, name: str, channel_id: int):
+        row = self.connection.execute('SELECT * FROM feeds WHERE name = ? AND channel_id = ?', (name, channel_id)).fetchone()
+        return None if row is None else self.row_to_feed(row)
+
+    def get_guild_feeds(self, guild_id: int):
+        rows = self.connection.execute('SELECT * FROM feeds WHERE guild_id = ? ORDER BY id', (guild_id,)).fetchall()
+        return [self.row_to_feed(row) for row in rows]
+
+    def get_all_feeds(self):
+        rows = self.connection.execute('SELECT * FROM feeds ORDER BY id').fetchall()
+        return [self.row_to_feed(row) for row in rows]
+
+    def count_feeds(self):
+        return self.connection.execute('SELECT COUNT(*) FROM feeds').fetchone()[0]
+
+    def add_feed(self, guild_id: int, name: str, channel_id: int, last_checked: int = -1, enabled: bool = True):
+        with self.connection:
+            self.connection.execute('INSERT INTO feeds (guild_id, name, channel_id, last_checked, enabled) VALUES (?, ?, ?, ?, ?)', (guild_id, name, channel_id, last_checked, int(enabled)))
+
+    def add_feeds(self, feeds: list):
+        rows = [(feed_data['guild_id'], feed_data['name'], feed_data['channel_id'], feed_data.get('last_checked', -1), int(feed_data.get('enabled', True))) for feed_data in feeds]
+        with self.connection:
+            cursor = self.connection.executemany('INSERT OR IGNORE INTO feeds (guild_id, name, channel_id, last_checked, enabled) VALUES (?, ?, ?, ?, ?)', rows)
+        return cursor.rowcount
+
+    def remove_feed(self, name: str, channel_id: int):
+        with self.connection:
+            self.connection.execute('DELETE FROM feeds WHERE name = ? AND channel_id = ?', (name, channel_id))
+        self.pending_poll_state.pop((name, channel_id), None)
+
+    def update_feed(self, name: str, channel_id: int, fields: dict):
+        columns = [column for column in fields if column in self.FEED_COLUMNS]
+        if columns == []:
+            return
+        assignments = ', '.join(f'{column} = ?' for column in columns)
+        values = [int(fields[column]) if column == 'enabled' else fields[column] for column in columns]
+        with self.connection:
+            self.connection.execute(f'UPDATE feeds SET {assignments} WHERE name = ? AND channel_id = ?', (*values, name, channel_id))
+        if 'channel_id' in fields and (name, channel_id) in self.pending_poll_state:
+            self.pending_poll_state[(name, fields['channel_id'])] = self.pending_poll_state.pop((name, channel_id))
+
+    def queue_poll_state(self, name: str, channel_id: int, last_checked: int, seen_ids: dict):
+        self.pending_poll_state[(name, channel_id)] = (last_checked, ' '.join(seen_ids))
+
+    def flush(self):
+        if self.pending_poll_state == {}:
+            return
+        updates = [(last_checked, seen_ids, name, channel_id) for (name, channel_id), (last_checked, seen_ids) in self.pending_poll_state.items()]
+        self.pending_poll_state = {}
+        with self.connection:
+            self.connection.executemany('UPDATE feeds SET last_checked = ?, seen_ids = ? WHERE name = ? AND channel_id = ?', updates)
+
+    def get_instances(self):
+        rows = self.connection.execute('SELECT domain FROM instances ORDER BY position').fetchall()
+        return [row['domain'] for row in rows]
+
+    def set_instances(self, domains: list):
+        with self.connection:
+            self.connection.execute('DELETE FROM instances')
+            self.connection.executemany('INSERT INTO instances (domain, position) VALUES (?, ?)', [(domain, position) for position, domain in enumerate(domains)])
+
+    def get_data_version(self):
+        return self.connection.execute('PRAGMA main.data_version').fetchone()[0]
+
+    def heartbeat(self, worker_id: str):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO state.poll_workers (worker_id, heartbeat) VALUES (?, ?)', (worker_id, time.time()))
+
+    def get_live_workers(self, timeout: float):
+        rows = self.connection.execute('SELECT worker_id FROM state.poll_workers WHERE heartbeat >= ? ORDER BY worker_id', (time.time() - timeout,)).fetchall()
+        return [row['worker_id'] for row in rows]
+
+    def get_command_hashes(self):
+        rows = self.connection.execute('SELECT guild_id, hash FROM state.command_syncs').fetchall()
+        return {row['guild_id']: row['hash'] for row in rows}
+
+    def set_command_hash(self, guild_id: int, command_hash: str):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO state.command_syncs (guild_id, hash) VALUES (?, ?)', (guild_id, command_hash))
+
+    def request_refresh(self, names: list):
+        with self.connection:
+            self.connection.executemany('INSERT OR IGNORE INTO state.refresh_requests (name) VALUES (?)', [(name,) for name in names])
+
+    def get_refresh_requests(self):
+        return [row['name'] for row in self.connection.execute('SELECT name FROM state.refresh_requests').fetchall()]
+
+    def clear_refresh_requests(self, names: list):
+        with self.connection:
+            self.connection.executemany('DELETE FROM state.refresh_requests WHERE name = ?', [(name,) for name in names])
+
+    def set_poll_summary(self, worker_id: str, summary: dict):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO state.poll_summaries (worker_id, updated, summary) VALUES (?, ?, ?)', (worker_id, time.time(), json.dumps(summary)))
+
+    def get_poll_summaries(self, timeout: float):
+        rows = self.connection.execute('SELECT worker_id, summary FROM state.poll_summaries WHERE updated >= ? ORDER BY worker_id', (time.time() - timeout,)).fetchall()
+        return {row['worker_id']: json.loads(row['summary']) for row in rows}
+
+# One-shot migration from the TinyDB files used by earlier versions.
+# The old files are renamed afterwards so the migration only runs once.
+def migrate_tinydb_storage(store: FeedStore, feeds_path: str = 'feeds.json', instance_path: str = 'instance.json'):
+    if os.path.exists(feeds_path):
+        if store.count_feeds() == 0:
+            feeds_db = TinyDB(feeds_path)
+            migrated = store.add_feeds(feeds_db.all())
+            logger.info('Migrated %s feeds from %s', migrated, feeds_path)
+            feeds_db.close()
+        os.replace(feeds_path, f'{feeds_path}.migrated')
+    if os.path.exists(instance_path):
+        if store.get_instances() == []:
+            instance_db = TinyDB(instance_path)
+            if len(instance_db) > 0 and instance_db.all()[0]['domain'] != '':
+                store.set_instances([instance_db.all()[0]['domain']])
+            instance_db.close()
+        os.replace(instance_path, f'{instance_path}.migrated')
+
+# In-memory copy of all subscriptions, loaded at startup and written through to the store.
+# Feeds are kept by (name, channel_id) and per guild, with each guild's keys sorted so
+# autocomplete can find usernames by prefix with a binary search.
+class SubscriptionIndex:
+    def __init__(self, store: FeedStore):
+        self.store = store
+        self.load()
+
+    def load(self):
+        self.feeds = {}
+        self.guild_feeds = {}
+        self.guild_keys = {}
+        self.data_version = self.store.get_data_version()
+        for feed_data in self.store.get_all_feeds():
+            self.index_feed(feed_data)
+
+    # Reload when another process (the bot or a poll worker) changed the store
+    def reload_if_changed(self):
+        if self.store.get_data_version() != self.data_version:
+            self.load()
+
+    def index_feed(self, feed_data):
+        key = (feed_data['name'], feed_data['channel_id'])
+        self.feeds[key] = feed_data
+        self.guild_feeds.setdefault(feed_data['guild_id'], {})[key] = feed_data
+        bisect.insort(self.guild_keys.setdefault(feed_data['guild_id'], []), key)
+
+    def unindex_feed(self, key):
+        feed_data = self.feeds.pop(key)
+        del self.guild_feeds[feed_data['guild_id']][key]
+        keys = self.guild_keys[feed_data['guild_id']]
+        del keys[bisect.bisect_left(keys, key)]
+        return feed_data
+
+    def get_feed(self, name: str, channel_id: int):
+        return self.feeds.get((name, channel_id))
+
+    def get_guild_feeds(self, guild_id: int):
+        return list(self.guild_feeds.get(guild_id, {}).values())
+
+    def get_all_feeds(self):
+        return list(self.feeds.values())
+
+    # Feeds in a guild whose username starts with prefix, followed by ones that only contain it
+    def search(self, guild_id: int, prefix: str, limit: int):
+        keys = self.guild_keys.get(guild_id, [])
+        matches = []
+        index = bisect.bisect_left(keys, (prefix,))
+        while index < len(keys) and keys[index][0].startswith(prefix) and len(matches) < limit:
+            matches.append(self.feeds[keys[index]])
+            index += 1
+        if len(matches) < limit and prefix != '':
+            for key in keys:
+                if prefix in key[0] and not key[0].startswith(prefix):
+                    matches.append(self.feeds[key])
+                    if len(matches) == limit:
+                        break
+        return matches
+
+    def add_feed(self, guild_id: int, name: str, channel_id: int):
+        self.store.add_feed(guild_id, name, channel_id)
+        self.index_feed({'guild_id': guild_id, 'name': name, 'channel_id': channel_id, 'last_checked': -1, 'seen_ids': {}, 'enabled': True})
+
+    # Add several new feeds in one transaction. Returns the number inserted.
+    def add_feeds(self, feeds: list):
+        added = self.store.add_feeds(feeds)
+        for feed_data in feeds:
+            if (feed_data['name'], feed_data['channel_id']) not in self.feeds:
+                self.index_feed({'guild_id': feed_data['guild_id'], 'name': feed_data['name'], 'channel_id': feed_data['channel_id'], 'last_checked': -1, 'seen_ids': {}, 'enabled': feed_data.get('enabled', True)})
+        return added
+
+    def remove_feed(self, name: str, channel_id: int):
+        self.store.remove_feed(name, channel_id)
+        self.unindex_feed((name, channel_id))
+
+    def update_feed(self, name: str, channel_id: int, fields: dict):
+        self.store.update_feed(name, channel_id, fields)
+        feed_data = self.unindex_feed((name, channel_id))
+        feed_data.update(fields)
+        self.index_feed(feed_data)
+
+    def queue_poll_state(self, name: str, channel_id: int, last_checked: int, seen_ids: dict):
+        self.store.queue_poll_state(name, channel_id, last_checked, seen_ids)
+        if (name, channel_id) in self.feeds:
+            self.feeds[(name, channel_id)]['last_checked'] = last_checked
+            self.feeds[(name, channel_id)]['seen_ids'] = seen_ids
+
+    def flush(self):
+        with metrics.time_stage('db_update'):
+            self.store.flush()
+
+# Storage is opened by open_storage() at startup rather than on import, so importing this module
+# (as the benchmarks do) doesn't touch the database or migrate feed files.
+feed_store = None
+state_store = None
+feed_index = None
+
+# Bot state database next to the feeds database, such as feeds-state.db for feeds.db
+def get_state_db_path(path: str):
+    if path == ':memory:':
+        return path
+    root, extension = os.path.splitext(path)
+    return f'{root}-state{extension}'
+
+# Open the database and load the subscriptions. Only the bot process migrates files from earlier
+# versions, before any poll worker starts.
+def open_storage(path: str, migrate: bool = False):
+    global feed_store, state_store, feed_index
+    feed_store = SQLiteStore(path, get_state_db_path(path))
+    # Shares the feed store's connection, so its own writes don't look like changes from another process
+    state_store = feed_store
+    if migrate:
+        migrate_tinydb_storage(feed_store)
+    feed_index = SubscriptionIndex(feed_store)
+
+# Pool of healthy Nitter instances, scored by the latency and error rate of real fetches
+class InstancePool:
+    def __init__(self):
+        self.stats = {}
+
+    def domains(self):
+        return list(self.stats)
+
+    # Replace the pool, keeping the measurements of instances that stay in it
+    def set_domains(self, domains: list, latencies: dict = None):
+        latencies = latencies or {}
+        self.stats = {domain: self.stats.get(domain, {'latency': latencies.get(domain, 1.0), 'errors': 0.0}) for domain in domains}
+
+    # Expected time per successful fetch, lower is better
+    def score(self, domain: str):
+        stats = self.stats[domain]
+        return stats['latency'] / max(1 - stats['errors'], 0.05)
+
+    def ranked(self):
+        return sorted(self.stats, key = self.score)
+
+    # Order to try instances in for one request. The first instance is picked at random weighted
+    # by score so load is spread across the pool, the rest follow as failover in score order.
+    def candidates(self):
+        ranked = self.ranked()
+        if len(ranked) <= 1:
+            return ranked
+        first = random.choices(ranked, weights = [1 / self.score(domain) for domain in ranked])[0]
+        return [first] + [domain for domain in ranked if domain != first]
+
+    def record_success(self, domain: str, latency: float):
+        if domain in self.stats:
+            stats = self.stats[domain]
+            stats['latency'] += INSTANCE_SCORE_SMOOTHING * (latency - stats['latency'])
+            stats['errors'] -= INSTANCE_SCORE_SMOOTHING * stats['errors']
+
+    def record_failure(self, domain: str):
+        if domain in self.stats:
+            stats = self.stats[domain]
+            stats['errors'] += INSTANCE_SCORE_SMOOTHING * (1 - stats['errors'])
+
+    # Restore measurements saved by a previous run. Raises KeyError, TypeError or ValueError on
+    # malformed data, before changing the pool.
+    def restore(self, stats: dict):
+        self.stats = {str(domain): {'latency': float(domain_stats['latency']), 'errors': float(domain_stats['errors'])} for domain, domain_stats in stats.items()}
+
+instance_pool = InstancePool()
+
+# Cache of fetched feeds. Validators and content hashes are kept per (instance, username) since
+# each instance serves its own copy of a feed. The newest post ID and parsed feed are kept per
+# username, as status IDs are the same on every instance.
+class FeedCache:
+    def __init__(self):
+        self.validators = {}
+        self.latest = {}
+
+    # Conditional request headers for an instance that sent ETag or Last-Modified before
+    def get_headers(self, domain: str, name: str):
+        validators = self.validators.get((domain, name), {})
+        headers = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+        return headers
+
+    # Latest entry for a username, if it was parsed completely or far enough to reach a post in stop_ids.
+    # With newest_only, any entry with at least one post will do.
+    def get_latest(self, name: str, stop_ids = None, newest_only: bool = False):
+        entry = self.latest.get(name)
+        if entry is None:
+            return None
+        rss = entry['rss']
+        if rss.complete or (newest_only and rss.entries != []) or (stop_ids is not None and any(post[2] in stop_ids for post in rss.entries)):
+            return entry
+        return None
+
+    # Latest entry for a username if it was fetched within max_age seconds and covers stop_ids
+    def get_fresh(self, name: str, max_age: float, stop_ids = None, newest_only: bool = False):
+        entry = self.get_latest(name, stop_ids, newest_only)
+        if entry is not None and time.time() - entry['fetched'] < max_age:
+            return entry
+        return None
+
+    def get_content_hash(self, domain: str, name: str):
+        return self.validators.get((domain, name), {}).get('hash')
+
+    def store(self, domain: str, name: str, headers, content_hash, top_id, rss):
+        self.validators[(domain, name)] = {
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'hash': content_hash,
+        }
+        self.latest[name] = {'fetched': time.time(), 'domain': domain, 'top_id': top_id, 'rss': rss}
+
+    def touch(self, name: str):
+        self.latest[name]['fetched'] = time.time()
+
+feed_cache = FeedCache()
+
+# Outgoing posts, queued per channel. Each channel with queued posts has a worker that combines
+# queued posts into as few messages as possible and paces sends to stay within Discord's
+# per-channel rate limit, so a busy channel never holds up fetching or other channels.
+class DeliveryQueue:
+    def __init__(self):
+        self.queues = {}
+        self.workers = {}
+        self.send_times = {}
+        self.sent_messages = 0
+        self.sent_posts = 0
+        self.failed_messages = 0
+        self.average_send_latency = 0.0
+
+    def enqueue(self, channel_id: int, messages: list):
+        queue = self.queues.setdefault(channel_id, collections.deque())
+        queue.extend(messages)
+        if channel_id not in self.workers and len(queue) > 0:
+            self.workers[channel_id] = asyncio.create_task(self.deliver(channel_id))
+
+    def depth(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def stats(self):
+        return {
+            'depth': self.depth(),
+            'active_channels': len(self.workers),
+            'sent_messages': self.sent_messages,
+            'sent_posts': self.sent_posts,
+            'failed_messages': self.failed_messages,
+            'average_send_latency': self.average_send_latency,
+        }
+
+    # Take the next queued post and as many following ones as fit in a single message
+    def next_batch(self, queue):
+        batch = [queue.popleft()]
+        length = len(batch[0])
+        while len(queue) > 0 and len(batch) < DELIVERY_BATCH_SIZE and length + 1 + len(queue[0]) <= MESSAGE_MAX_LENGTH:
+            message = queue.popleft()
+            batch.append(message)
+            length += 1 + len(message)
+        return batch
+
+    # Wait until another message can be sent to the channel without hitting the rate limit
+    async def wait_for_rate_limit(self, channel_id: int):
+        send_times = self.send_times.setdefault(channel_id, collections.deque(maxlen = DELIVERY_RATE_LIMIT))
+        if len(send_times) == DELIVERY_RATE_LIMIT:
+            delay = send_times[0] + DELIVERY_RATE_PERIOD - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        send_times.append(time.monotonic())
+
+    # Errors worth retrying a send for: Discord server errors, timeouts and connection errors.
+    # Others (such as missing permissions or a deleted channel) will fail again.
+    @staticmethod
+    def is_transient_error(error):
+        return isinstance(error, (discord.DiscordServerError, asyncio.TimeoutError, aiohttp.ClientError, OSError))
+
+    # A batch that fails with a transient error goes back to the front of the queue and is retried
+    # with a backoff, up to DELIVERY_MAX_ATTEMPTS times, before its posts are dropped.
+    async def deliver(self, channel_id: int):
+        queue = self.queues[channel_id]
+        channel = bot.get_partial_messageable(channel_id)
+        attempts = 0
+        try:
+            while len(queue) > 0:
+                batch = self.next_batch(queue)
+                await self.wait_for_rate_limit(channel_id)
+                start_time = time.perf_counter()
+                attempts += 1
+                try:
+                    with metrics.time_stage('send'):
+                        await channel.send('\n'.join(batch))
+                    self.sent_messages += 1
+                    self.sent_posts += len(batch)
+                    metrics.increment('nitter_bot_delivered_posts_total', len(batch))
+                    attempts = 0
+                except Exception as e:
+                    metrics.increment('nitter_bot_delivery_failures_total')
+                    if self.is_transient_error(e) and attempts < DELIVERY_MAX_ATTEMPTS:
+                        logger.warning('Sending to channel %s failed, retrying (attempt %s): %s', channel_id, attempts, e)
+                        queue.extendleft(reversed(batch))
+                        await asyncio.sleep(DELIVERY_RETRY_SECONDS * 2 ** (attempts - 1))
+                    else:
+                        logger.error('Sending %s posts to channel %s failed: %s', len(batch), channel_id, e)
+                        self.failed_messages += 1
+                        attempts = 0
+                latency = time.perf_counter() - start_time
+                self.average_send_latency += 0.2 * (latency - self.average_send_latency)
+        finally:
+            del self.workers[channel_id]
+            if len(queue) == 0:
+                del self.queues[channel_id]
+
+    # Wait up to timeout seconds for queued posts to be sent. Returns the number of posts left.
+    async def drain(self, timeout: float):
+        if self.workers != {}:
+            await asyncio.wait(list(self.workers.values()), timeout = timeout)
+        return self.depth()
+
+delivery_queue = DeliveryQueue()
+
+# Schedules each username by its next due time. The poll interval follows a moving average of
+# the account's posting rate, aiming for about one new post per poll, and backs off
+# exponentially on repeated failures. New usernames are spread evenly over their first interval.
+class FeedScheduler:
+    def __init__(self):
+        self.heap = []
+        self.state = {}
+
+    def push(self, name: str, next_due: float):
+        self.state[name]['next_due'] = next_due
+        heapq.heappush(self.heap, (next_due, name))
+
+    # Add usernames that aren't scheduled yet and drop ones with no enabled subscriptions left
+    def sync(self, names: set):
+        for name in list(self.state):
+            if name not in names:
+                del self.state[name]
+        now = time.time()
+        for name in names:
+            if name not in self.state:
+                interval = FEED_REFRESH_INTERVAL_MINUTES * 60
+                self.state[name] = {'interval': interval, 'rate': 1 / interval, 'failures': 0, 'last_polled': None}
+                offset = zlib.crc32(name.encode()) / 2**32 * interval
+                self.push(name, now + offset)
+
+    # Pop usernames that are due. Heap entries left behind by a reschedule are skipped.
+    def pop_due(self, now: float):
+        due_names = []
+        while self.heap != [] and self.heap[0][0] <= now:
+            next_due, name = heapq.heappop(self.heap)
+            if name in self.state and self.state[name]['next_due'] == next_due:
+                due_names.append(name)
+        return due_names
+
+    # new_posts is the number of posts the poll found that hadn't been seen before, or None when
+    # that isn't known (no subscription to the username has seen any posts yet)
+    def record_success(self, name: str, new_posts: Optional[int]):
+        if name not in self.state:
+            return
+        state = self.state[name]
+        now = time.time()
+        if state['last_polled'] is not None and new_posts is not None:
+            observed_rate = new_posts / max(now - state['last_polled'], 1)
+            state['rate'] += 0.3 * (observed_rate - state['rate'])
+        state['interval'] = min(max(1 / max(state['rate'], 1e-9), FEED_MIN_INTERVAL_MINUTES * 60), FEED_MAX_INTERVAL_MINUTES * 60)
+        state['failures'] = 0
+        state['last_polled'] = now
+        self.push(name, now + state['interval'])
+
+    def record_failure(self, name: str):
+        if name not in self.state:
+            return
+        state = self.state[name]
+        state['failures'] += 1
+        delay = min(state['interval'] * 2 ** state['failures'], FEED_MAX_INTERVAL_MINUTES * 60)
+        self.push(name, time.time() + delay)
+
+    # Restore schedules saved by a previous run. sync() keeps usernames that are already scheduled,
+    # so restored usernames stay on their schedule and ones that became due while stopped are polled first.
+    # Raises KeyError, TypeError or ValueError on malformed data, before changing any schedule.
+    def restore(self, states: dict):
+        restored = {}
+        for name, state in states.items():
+            last_polled = None if state['last_polled'] is None else float(state['last_polled'])
+            restored[str(name)] = {'interval': float(state['interval']), 'rate': float(state['rate']), 'failures': int(state['failures']), 'last_polled': last_polled, 'next_due': float(state['next_due'])}
+        for name, state in restored.items():
+            self.state[name] = state
+            self.push(name, state['next_due'])
+
+feed_scheduler = FeedScheduler()
+
+# Timing of the most recent poll cycle
+last_poll_cycle = {}
+
+# Startup time, and how long after it the first scheduled poll cycle finished
+process_start_time = time.time()
+first_poll_seconds = None
 
 # Define intents
 intents = discord.Intents.default()
 intents.message_content = True
+# HTTP session shared by every request to Nitter and the status API, so connections stay warm
+# between polls and commands. Created when the bot starts and closed when it shuts down.
+http_session = None
+
+# The connection limits keep concurrent fetches from flooding a single instance
+def create_http_session():
+    connector = aiohttp.TCPConnector(
+        limit = FEED_FETCH_CONCURRENCY,
+        limit_per_host = FEED_FETCH_PER_HOST_LIMIT,
+        keepalive_timeout = HTTP_KEEPALIVE_SECONDS,
+        ttl_dns_cache = HTTP_DNS_CACHE_SECONDS,
+    )
+    timeout = aiohttp.ClientTimeout(total = HTTP_TIMEOUT_SECONDS, connect = HTTP_CONNECT_TIMEOUT_SECONDS)
+    headers = {'Accept-Encoding': 'gzip, deflate' if HTTP_COMPRESSION else 'identity'}
+    return aiohttp.ClientSession(connector = connector, timeout = timeout, headers = headers)
+
+class NitterBot(discord.Client):
+    metrics_runner = None
+    close_task = None
+
+    async def setup_hook(self):
+        global http_session
+        http_session = create_http_session()
+        if METRICS_PORT != 0:
+            try:
+                self.metrics_runner = await start_metrics_server()
+            except OSError as e:
+                logger.error('Could not start metrics server: %s', e)
+        # Shut down cleanly on SIGTERM too, so the state snapshot is written
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, self.handle_sigterm)
+        except NotImplementedError:
+            pass
+
+    def handle_sigterm(self):
+        self.close_task = asyncio.create_task(self.close())
+
+    async def close(self):
+        if not self.is_closed():
+            # Posts in the delivery queue are already marked as seen, so send them before disconnecting
+            undelivered = await delivery_queue.drain(DELIVERY_DRAIN_SECONDS)
+            if undelivered > 0:
+                logger.error('Shutting down with %s posts not delivered', undelivered)
+            try:
+                save_state_snapshot()
+            except OSError as e:
+                logger.error('Could not save state snapshot: %s', e)
+        await super().close()
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+        if http_session is not None:
+            await http_session.close()
+        if parse_executor is not None:
+            parse_executor.shutdown(wait = False, cancel_futures = True)
+
 # Gets the client object from discord.py. Client is synonymous with bot.
-bot = discord.Client(intents = intents)
+bot = NitterBot(intents = intents)
 # Define tree which will hold application commands
 tree = app_commands.CommandTree(bot)
 
 async def get_instance_from_database():
-    global instance_domain
-    if len(instance_db) == 0:
-        instance_domain = ''
+    instance_pool.set_domains(feed_store.get_instances())
+
+# Warm state kept across restarts: instance measurements and the poll schedule. Written at shutdown
+# and restored at startup, so polling can resume right away without probing instances first.
+def save_state_snapshot():
+    snapshot = {'saved': time.time(), 'instances': instance_pool.stats, 'scheduler': feed_scheduler.state}
+    temp_path = f'{STATE_SNAPSHOT_PATH}.tmp'
+    with open(temp_path, 'w', encoding = 'utf-8') as file:
+        json.dump(snapshot, file)
+    os.replace(temp_path, STATE_SNAPSHOT_PATH)
+    logger.info('Saved state snapshot to %s', STATE_SNAPSHOT_PATH)
+
+# A missing or malformed snapshot is logged and the bot starts cold.
+def load_state_snapshot():
+    try:
+        with open(STATE_SNAPSHOT_PATH, encoding = 'utf-8') as file:
+            snapshot = json.load(file)
+        if not isinstance(snapshot, dict) or not isinstance(snapshot.get('instances'), dict) or not isinstance(snapshot.get('scheduler'), dict):
+            raise ValueError('missing instances or scheduler')
+        saved = float(snapshot.get('saved', 0))
+        if snapshot['instances'] != {}:
+            instance_pool.restore(snapshot['instances'])
+        feed_scheduler.restore(snapshot['scheduler'])
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        logger.warning('Could not load state snapshot: %s', e)
+        return
+    logger.info('Restored %s instances and %s feed schedules from a snapshot taken %.0fs ago', len(snapshot['instances']), len(snapshot['scheduler']), time.time() - saved)
+
+# Commands are defined globally and copied to each guild when it is synced, so every guild gets
+# the same payload. Its hash is kept per guild to skip syncs when nothing changed.
+def get_command_hash():
+    payload = [command.to_dict(tree) for command in tree.get_commands()]
+    return hashlib.sha1(json.dumps(payload, sort_keys = True).encode()).hexdigest()
+
+async def sync_guild_commands(guild, command_hash: str, semaphore):
+    async with semaphore:
+        tree.copy_global_to(guild = guild)
+        await tree.sync(guild = guild) #guild = discord.Object(id = GUILD_ID))
+    state_store.set_command_hash(guild.id, command_hash)
+
+# Sync slash commands to the guilds whose commands changed since their last sync, several at a time
+async def sync_commands():
+    try:
+        synced_hashes = state_store.get_command_hashes()
+        semaphore = asyncio.Semaphore(COMMAND_SYNC_CONCURRENCY)
+        command_hash = get_command_hash()
+        guilds = [guild for guild in bot.guilds if synced_hashes.get(guild.id) != command_hash]
+        results = await asyncio.gather(*[sync_guild_commands(guild, command_hash, semaphore) for guild in guilds], return_exceptions = True)
+        for guild, result in zip(guilds, results):
+            if isinstance(result, BaseException):
+                logger.error('Could not sync slash commands to guild %s: %s', guild.id, result)
+        logger.info('Synced slash commands to %s of %s guilds', len(guilds), len(bot.guilds))
+    except Exception as e:
+        logger.exception('Error in sync_commands: %s', e)
+
+# Sharded polling: with POLL_WORKERS set, the bot process only handles Discord and commands, and
+# separate poll worker processes share the feeds through the SQLite store. Each username belongs to
+# one live worker by rendezvous hashing, so when a worker stops sending heartbeats its usernames
+# spread over the remaining workers and nothing else moves. The live worker with the lowest ID is
+# the leader and is the only one that probes and discovers instances.
+poll_worker_id = None
+live_poll_workers = []
+
+def update_poll_worker_membership():
+    global live_poll_workers
+    state_store.heartbeat(poll_worker_id)
+    live_poll_workers = state_store.get_live_workers(POLL_WORKER_TIMEOUT_SECONDS)
+    if poll_worker_id not in live_poll_workers:
+        live_poll_workers = sorted(live_poll_workers + [poll_worker_id])
+
+def owns_feed(name: str):
+    if poll_worker_id is None:
+        return True
+    return max(live_poll_workers, key = lambda worker_id: hashlib.blake2b(f'{worker_id}:{name}'.encode(), digest_size = 8).digest()) == poll_worker_id
+
+def is_instance_leader():
+    if poll_worker_id is None:
+        return POLL_WORKERS == 0
+    return live_poll_workers != [] and live_poll_workers[0] == poll_worker_id
+
+# Feeds this process may poll. Poll workers don't connect to the gateway, so they can't see which
+# guilds the bot is in and poll every feed.
+def get_polled_feeds():
+    if poll_worker_id is not None:
+        return feed_index.get_all_feeds()
+    return [feed_data for guild in bot.guilds for feed_data in feed_index.get_guild_feeds(guild.id)]
+
+# Pick up feeds and instances changed by other processes
+async def load_shared_state():
+    feed_index.reload_if_changed()
+    if not is_instance_leader():
+        await get_instance_from_database()
+
+# Request a feed URL from the instance pool, failing over to the next instance when one fails.
+# A 404 means the account does not exist, so it is raised without trying other instances.
+# headers_for is called with each domain to get extra request headers for it.
+# Returns the domain that answered, the response status and headers, and the body.
+async def request_from_pool(method: str, path: str, session, headers_for = None):
+    last_error = ValueError('No Nitter instances available')
+    for domain in instance_pool.candidates():
+        start_time = time.perf_counter()
+        headers = headers_for(domain) if headers_for is not None else {}
+        try:
+            async with session.request(method, f'{INSTANCE_URL_SCHEME}://{domain}{path}', headers = headers) as response:
+                body = await response.read() if method == 'GET' else b''
+                metrics.observe('nitter_bot_upstream_latency_seconds', time.perf_counter() - start_time, instance = domain)
+                if response.status == 404:
+                    instance_pool.record_success(domain, time.perf_counter() - start_time)
+                    raise LookupError(f'Response status: {response.status}')
+                if response.status not in (200, 304):
+                    instance_pool.record_failure(domain)
+                    metrics.increment('nitter_bot_upstream_failures_total', instance = domain)
+                    last_error = ValueError(f'{domain} response status: {response.status}')
+                    continue
+                instance_pool.record_success(domain, time.perf_counter() - start_time)
+                return domain, response.status, response.headers, body
+        except LookupError:
+            raise
+        except Exception as e:
+            instance_pool.record_failure(domain)
+            metrics.increment('nitter_bot_upstream_failures_total', instance = domain)
+            last_error = e
+    raise last_error
+
+# ID of the newest post in a raw RSS body, found without parsing the whole document. It is taken
+# from the first item's <link>, as the description before it can link to a quoted post.
+def get_top_post_id(body: bytes):
+    item_start = body.find(b'<item>')
+    if item_start == -1:
+        return None
+    item_end = body.find(b'</item>', item_start)
+    link_start = body.find(b'<link>', item_start, item_end)
+    link_end = body.find(b'</link>', link_start, item_end)
+    if item_end == -1 or link_start == -1 or link_end == -1:
+        return None
+    match = STATUS_ID_BYTES_PATTERN.search(body, link_start, link_end)
+    return match.group(1).decode() if match else None
+
+# Parsed feed: the feed title, (timestamp, link, status ID) for each post, newest first, and whether
+# the whole feed was parsed. The parsers in rss_parser return plain tuples so results pass cheaply between processes.
+class ParsedFeed(NamedTuple):
+    title: str
+    entries: list
+    complete: bool
+
+# Executor that parses feeds off the event loop, created on first use
+parse_executor = None
+
+# Each poll worker gets its share of the CPUs, so the workers together run one parse process per CPU
+def get_parse_worker_count():
+    if PARSE_WORKERS is not None or poll_worker_id is None:
+        return PARSE_WORKERS
+    return max((os.cpu_count() or 1) // POLL_WORKERS, 1)
+
+def get_parse_executor():
+    global parse_executor
+    if parse_executor is None:
+        if PARSE_EXECUTOR == 'process':
+            parse_executor = concurrent.futures.ProcessPoolExecutor(max_workers = get_parse_worker_count(), mp_context = multiprocessing.get_context('spawn'))
+        elif PARSE_EXECUTOR == 'thread':
+            parse_executor = concurrent.futures.ThreadPoolExecutor(max_workers = get_parse_worker_count())
+    return parse_executor
+
+async def parse_rss_feed_async(body: bytes, stop_ids = None):
+    executor = get_parse_executor()
+    if executor is None:
+        result, error, parse_seconds = parse_rss_feed(body, stop_ids)
     else:
-        instance_domain = instance_db.get(doc_id = 1)['domain']
+        result, error, parse_seconds = await asyncio.get_running_loop().run_in_executor(executor, parse_rss_feed, body, stop_ids)
+    # The parse stage also counts waiting for the executor, this is the parsing itself
+    metrics.observe('nitter_bot_parse_seconds', parse_seconds)
+    if error is not None:
+        logger.warning('Fast RSS parser failed, using feedparser: %s', error)
+    return ParsedFeed(*result)
 
-async def get_rss_feed(name: str, session):
-    async with session.get(f"https://{instance_domain}/{name}/rss") as response:
-        html = await response.text()
-        rss_posts = feedparser.parse(html)
-        return rss_posts
+# Status IDs to stop parsing a feed at when it is shared by several subscriptions: posts all of them
+# have seen. A subscription that hasn't seen any posts yet needs the whole feed (None).
+def get_parse_stop_ids(feeds):
+    if any(len(feed_data['seen_ids']) == 0 for feed_data in feeds):
+        return None
+    return frozenset(feeds[0]['seen_ids']).intersection(*[feed_data['seen_ids'] for feed_data in feeds[1:]])
+
+# Fetch and parse a feed, covering at least the posts before the first one in stop_ids (None for all posts),
+# or only the newest post with newest_only. Returns the domain of the instance that answered and the parsed feed.
+# A fetch made within max_age seconds is reused. Otherwise the feed is requested conditionally,
+# and parsing is skipped when the body or its newest post are unchanged.
+async def get_rss_feed(name: str, session, stop_ids = None, max_age: float = FEED_CACHE_TTL_SECONDS, newest_only: bool = False):
+    cached = feed_cache.get_fresh(name, max_age, stop_ids, newest_only)
+    if cached is not None:
+        return cached['domain'], cached['rss']
+    cached = feed_cache.get_latest(name, stop_ids, newest_only)
+    # Only ask for a 304 if the cached parse can be reused for these stop IDs
+    headers_for = (lambda domain: feed_cache.get_headers(domain, name)) if cached is not None else None
+    with metrics.time_stage('fetch'):
+        domain, status, headers, body = await request_from_pool('GET', f'/{name}/rss', session, headers_for)
+    metrics.increment('nitter_bot_polls_total', instance = domain)
+    if status == 304 and cached is not None:
+        feed_cache.touch(name)
+        return domain, cached['rss']
+    content_hash = hashlib.sha1(body).digest()
+    top_id = get_top_post_id(body)
+    if cached is not None and (content_hash == feed_cache.get_content_hash(domain, name) or (top_id is not None and top_id == cached['top_id'])):
+        rss_posts = cached['rss']
+        metrics.increment('nitter_bot_parses_skipped_total')
+    else:
+        with metrics.time_stage('parse'):
+            rss_posts = await parse_rss_feed_async(body, stop_ids)
+    feed_cache.store(domain, name, headers, content_hash, top_id, rss_posts)
+    return domain, rss_posts
 
 async def check_feed_status(name: str, session):
-    async with session.head(f'https://{instance_domain}/{name}/rss') as response:
-        if response.status != 200:
-            raise ValueError(f'Response status: {response.status}')
+    await request_from_pool('HEAD', f'/{name}/rss', session)
 
 async def check_instance_status(domain: str, session):
-    async with session.head(f'https://{domain}/{REFERENCE_FEED}/rss') as response:
+    async with session.head(f'{INSTANCE_URL_SCHEME}://{domain}/{REFERENCE_FEED}/rss') as response:
         if response.status != 200:
             raise ValueError(f'Response status: {response.status}')
 
@@ -77,99 +1126,300 @@ async def get_instances(session):
         response_json = await response.json()
         return response_json['hosts']
 
-async def get_fastest_instance():
-    min_response_time = -1
-    fastest_domain = ''
-    async with aiohttp.ClientSession() as session:
-        hosts = await get_instances(session)
-        for index in range(len(hosts)):
-            if hosts[index]['healthy'] and hosts[index]['rss'] and (min_response_time == -1 or hosts[index]['ping_avg'] < min_response_time):
-                print(f"Found lower response time: {hosts[index]['domain']} with time of {hosts[index]['ping_avg']}")
-                try:
-                    await check_instance_status(hosts[index]['domain'], session)
-                    min_response_time = hosts[index]['ping_avg']
-                    fastest_domain = hosts[index]['domain']
-                except Exception as e:
-                    print(f'Error: {e}')
-    #print(f"Fastest instance: {fastest_domain}, response time: {min_response_time}")
-    return fastest_domain
-
-# Get working instance with RSS - on first load when database empty and when fetching feed fails
-async def update_instance(session):
-    global instance_domain
+# Probe an instance, recording the result in the pool. Returns whether the instance is healthy.
+async def probe_instance(domain: str, session):
+    start_time = time.perf_counter()
     try:
-        await check_instance_status(instance_domain, session)
+        await check_instance_status(domain, session)
+        instance_pool.record_success(domain, time.perf_counter() - start_time)
+        return True
     except Exception as e:
-        print(f'Error: {e}')
-        instance_domain = await get_fastest_instance()
-        if len(instance_db) == 0:
-            instance_db.insert({'domain':instance_domain})
-        else:
-            instance_db.update({'domain':instance_domain}, doc_ids = [1])
-            print(f"Updated instance in database to: {instance_db.all()[0]['domain']}")
-        print(f"Current instance changed to: {instance_domain}")
+        logger.warning('Instance probe failed: domain=%s error=%s', domain, e)
+        instance_pool.record_failure(domain)
+        return False
+
+# Find healthy instances with RSS from the status API, probing the fastest candidates concurrently
+async def discover_instances(session):
+    hosts = await get_instances(session)
+    hosts = sorted([host for host in hosts if host['healthy'] and host['rss']], key = lambda host: host['ping_avg'])
+    candidates = hosts[:INSTANCE_POOL_SIZE * 3]
+    results = await asyncio.gather(*[check_instance_status(host['domain'], session) for host in candidates], return_exceptions = True)
+    healthy_hosts = [host for host, result in zip(candidates, results) if not isinstance(result, BaseException)]
+    return {host['domain']: host['ping_avg'] / 1000 for host in healthy_hosts[:INSTANCE_POOL_SIZE]}
+
+# Re-probe the pool and run discovery again only when it has fewer healthy instances than wanted
+async def refresh_instance_pool(session):
+    domains = instance_pool.domains()
+    results = await asyncio.gather(*[probe_instance(domain, session) for domain in domains])
+    healthy_domains = [domain for domain, healthy in zip(domains, results) if healthy]
+    if len(healthy_domains) < INSTANCE_POOL_SIZE:
+        try:
+            latencies = await discover_instances(session)
+            healthy_domains += [domain for domain in latencies if domain not in healthy_domains]
+            instance_pool.set_domains(healthy_domains[:INSTANCE_POOL_SIZE], latencies)
+        except Exception as e:
+            logger.error('Instance discovery failed: %s', e)
+            instance_pool.set_domains(healthy_domains or domains)
+    else:
+        instance_pool.set_domains(healthy_domains)
+    feed_store.set_instances(instance_pool.ranked())
+    logger.info('Instance pool: %s', ', '.join(instance_pool.ranked()))
 
 async def feeds_autocomplete(
     interaction: discord.Interaction,
     current: str,
 ) -> List[app_commands.Choice[str]]:
     choices = []
-    for entry in feeds_db.search(Query().guild_id == interaction.guild.id):
+    prefix = current.strip().lstrip('@').lower()
+    for entry in feed_index.search(interaction.guild.id, prefix, AUTOCOMPLETE_MAX_CHOICES):
         display_name = f"Feed: {entry['name']}, Channel: {bot.get_channel(entry['channel_id'])}"
         choice_value = f"{entry['name']}{TOKEN_SEPARATOR}{entry['channel_id']}"
         choices.append(app_commands.Choice(name = display_name, value = choice_value))
     return choices
 
-async def get_timestamp_from_struct(time: time.struct_time):
-    original_datetime = datetime.fromtimestamp(mktime(time))
-    localized_datetime = PUBLISHED_TIMEZONE.localize(original_datetime)
-    timestamp = int(datetime.timestamp(localized_datetime))
-    return timestamp
-
-async def get_display_timestamp(time: time.struct_time):
-    timestamp = await get_timestamp_from_struct(time)
+async def get_display_timestamp(timestamp: int):
     return f'<t:{timestamp:.0f}:f>'
 
 async def output_error_feed_not_found(name: str):
     return f'{ERROR_MSG} The feed \'{name}\' could not be found.'
 
 async def get_display_link(original_link: str):
-    return original_link.replace(instance_domain, DISPLAY_DOMAIN)
+    return urlunsplit(urlsplit(original_link)._replace(netloc = DISPLAY_DOMAIN))
 
 async def get_feed_data_from_identifier(identifier: str):
     tokens = identifier.split(TOKEN_SEPARATOR)
-    return feeds_db.get((Query()['name'] == tokens[0]) & (Query()['channel_id'] == int(tokens[1])))
+    return feed_index.get_feed(tokens[0], int(tokens[1]))
+
+# Username from an imported value: a username, @username or a profile or feed URL
+def get_import_name(value: str):
+    value = value.strip()
+    if '/' in value:
+        if '://' not in value:
+            value = f'https://{value}'
+        value = urlsplit(value).path.strip('/').split('/')[0]
+    return value.lstrip('@').lower()
 
-# Stores latest posts and updates last checked timestamp for feed
+# Entries of a /import-feeds file as (username, channels, enabled), where channels are the channel
+# values to try in order. OPML files give feed URLs only. Other files have one feed per line: the
+# username, optionally followed by a channel ID, mention or name, separated by a comma or whitespace.
+# This includes the CSV written by /export-feeds, whose channel name is tried when its channel ID
+# belongs to another server.
+def parse_import_file(content: str):
+    if content.lstrip().startswith('<'):
+        root = ElementTree.fromstring(content.strip())
+        return [(get_import_name(outline.get('xmlUrl')), [], True) for outline in root.iter('outline') if outline.get('xmlUrl')]
+    entries = []
+    for row in csv.reader(io.StringIO(content)):
+        tokens = [token.strip() for token in row] if len(row) > 1 else ''.join(row).split()
+        if tokens == [] or tokens[0] == '' or tokens[0].startswith('#'):
+            continue
+        if entries == [] and tokens[0].lower() in ('name', 'username'):
+            continue
+        channels = [token for token in tokens[1:3] if token != '']
+        enabled = len(tokens) < 4 or tokens[3].lower() != 'false'
+        entries.append((get_import_name(tokens[0]), channels, enabled))
+    return entries
+
+# Text channel in a guild from an ID, mention or name
+def resolve_import_channel(guild, value: str):
+    match = re.fullmatch(r'<#(\d+)>|(\d+)', value)
+    if match:
+        channel = guild.get_channel(int(match.group(1) or match.group(2)))
+    else:
+        channel = discord.utils.get(guild.text_channels, name = value.lstrip('#'))
+    return channel if isinstance(channel, discord.TextChannel) else None
+
+# Check a username exists, waiting for a free slot in the semaphore shared by the import
+async def check_import_feed(name: str, session, semaphore):
+    async with semaphore:
+        await check_feed_status(name, session)
+
+# Validate and add imported feeds. Each entry goes to the first of its channels found in the guild,
+# or to default_channel when none is. Each username is checked once, with the checks running
+# concurrently, and the new feeds are inserted in one transaction.
+# Returns the number of feeds added and (name, channel_id, result) for each entry, in file order.
+async def import_feed_entries(guild, entries, default_channel, session):
+    results = []
+    new_feeds = {}
+    for name, channel_values, enabled in entries:
+        channels = [resolve_import_channel(guild, value) for value in channel_values] + [default_channel]
+        channel = next((channel for channel in channels if channel is not None), None)
+        if USERNAME_PATTERN.fullmatch(name) is None:
+            results.append([name, None, 'invalid username'])
+        elif channel is None:
+            results.append([name, None, 'no channel given' if channel_values == [] else f"channel {' or '.join(channel_values)} not found"])
+        elif (name, channel.id) in new_feeds or feed_index.get_feed(name, channel.id) is not None:
+            results.append([name, channel.id, 'already added'])
+        else:
+            new_feeds[(name, channel.id)] = {'guild_id': guild.id, 'name': name, 'channel_id': channel.id, 'enabled': enabled}
+            results.append([name, channel.id, None])
+    names = list({name for name, channel_id in new_feeds})
+    semaphore = asyncio.Semaphore(FEED_FETCH_CONCURRENCY)
+    checks = dict(zip(names, await asyncio.gather(*[check_import_feed(name, session, semaphore) for name in names], return_exceptions = True)))
+    feeds = []
+    for result in results:
+        if result[2] is not None:
+            continue
+        error = checks[result[0]]
+        if isinstance(error, LookupError):
+            result[2] = 'account not found'
+        elif isinstance(error, BaseException):
+            result[2] = 'could not be checked'
+        else:
+            feeds.append(new_feeds[(result[0], result[1])])
+            result[2] = 'added'
+    added = feed_index.add_feeds(feeds) if feeds != [] else 0
+    return added, results
+
+# Returns the posts newer than the first one the subscription has already seen, oldest first, and
+# remembers them as seen. last_checked becomes the publish time of the newest post seen.
+# A new subscription gets only the newest post, with the rest of the feed marked as seen.
 async def get_latest_posts(feed_data, rss_feed, session):
-    posts = []
-    if feed_data['last_checked'] == -1:
-        posts.append(rss_feed.entries[0])
+    seen_ids = feed_data['seen_ids']
+    unseen_posts = []
+    for post in rss_feed.entries:
+        if post[2] in seen_ids:
+            break
+        unseen_posts.insert(0, post)
+    if unseen_posts == []:
+        return []
+    if len(seen_ids) > 0:
+        posts = unseen_posts
+    elif feed_data['last_checked'] == -1:
+        posts = unseen_posts[-1:]
     else:
-        for post in rss_feed.entries:
-            timestamp = await get_timestamp_from_struct(post.published_parsed)
-            if timestamp > feed_data['last_checked']:
-                posts.insert(0, post)
-            else:
-                break
-    current_timestamp = int(datetime.timestamp(datetime.now()))
-    feeds_db.update({'last_checked': current_timestamp}, (Query()['name'] == feed_data['name']) & (Query()['channel_id'] == feed_data['channel_id']))
+        # Subscriptions polled before seen IDs were stored
+        posts = [post for post in unseen_posts if post[0] > feed_data['last_checked']]
+    seen_ids = dict(seen_ids)
+    for post in unseen_posts:
+        seen_ids[post[2]] = None
+    for post_id in list(seen_ids)[:-SEEN_IDS_LIMIT]:
+        del seen_ids[post_id]
+    last_checked = max(feed_data['last_checked'], unseen_posts[-1][0])
+    feed_index.queue_poll_state(feed_data['name'], feed_data['channel_id'], last_checked, seen_ids)
     return posts
 
+# Number of posts in a feed before the first one any of its subscriptions has seen, counted by
+# status ID rather than publish time so posts Nitter indexes late are counted too. None when no
+# subscription has seen any posts yet.
+def count_unseen_posts(rss, feeds):
+    counts = []
+    for feed_data in feeds:
+        if len(feed_data['seen_ids']) > 0:
+            counts.append(next((index for index, post in enumerate(rss.entries) if post[2] in feed_data['seen_ids']), len(rss.entries)))
+    return min(counts) if counts != [] else None
+
+# Fetch a username once, waiting for a free slot in the semaphore shared by the cycle
+async def fetch_rss_feed(name: str, session, semaphore, stop_ids):
+    async with semaphore:
+        return await get_rss_feed(name, session, stop_ids)
+
+# Fetch feeds concurrently. Each username is fetched and parsed once, then every subscription
+# to it picks out the posts it hasn't seen from the same result.
+# Returns (feed_data, result) pairs, where result is (rss, posts, domain) or the raised exception.
+async def fetch_feed_updates(feeds, session):
+    subscriptions = {}
+    for feed_data in feeds:
+        subscriptions.setdefault(feed_data['name'], []).append(feed_data)
+    semaphore = asyncio.Semaphore(FEED_FETCH_CONCURRENCY)
+    names = list(subscriptions)
+    results = await asyncio.gather(*[fetch_rss_feed(name, session, semaphore, get_parse_stop_ids(subscriptions[name])) for name in names], return_exceptions = True)
+    updates = []
+    for name, result in zip(names, results):
+        if isinstance(result, BaseException):
+            feed_scheduler.record_failure(name)
+        else:
+            domain, rss = result
+            feed_scheduler.record_success(name, count_unseen_posts(rss, subscriptions[name]))
+        for feed_data in subscriptions[name]:
+            if isinstance(result, BaseException):
+                updates.append((feed_data, result))
+                continue
+            try:
+                posts = await get_latest_posts(feed_data, rss, session)
+                updates.append((feed_data, (rss, posts, domain)))
+            except Exception as e:
+                updates.append((feed_data, e))
+    return updates
+
+async def format_post(rss, post):
+    timestamp = await get_display_timestamp(post[0])
+    link = await get_display_link(post[1])
+    return f'**{rss.title}** ({timestamp}):\n{link}'
+
+# Queue posts for delivery to a channel
+async def send_posts(channel_id: int, rss, posts):
+    messages = [await format_post(rss, post) for post in posts]
+    delivery_queue.enqueue(channel_id, messages)
+
+# Poll a list of feeds: fetch all of them first, then queue the new posts for delivery.
+# Returns lists of successful and failed updates.
+async def poll_feeds(feeds, session):
+    successful_updates = []
+    failed_updates = []
+    start_time = time.perf_counter()
+    updates = await fetch_feed_updates(feeds, session)
+    feed_index.flush()
+    fetch_end_time = time.perf_counter()
+    for feed_data, result in updates:
+        try:
+            if isinstance(result, BaseException):
+                raise result
+            rss, posts, domain = result
+            await send_posts(feed_data['channel_id'], rss, posts)
+            metrics.increment('nitter_bot_new_posts_total', len(posts), instance = domain)
+            successful_updates.append({'name': feed_data['name'], 'channel_id': feed_data['channel_id'], 'posts': len(posts)})
+        except Exception as e:
+            logger.warning('Feed update failed: name=%s channel_id=%s error=%s', feed_data['name'], feed_data['channel_id'], e)
+            failed_updates.append({'name': feed_data['name'], 'channel_id': feed_data['channel_id']})
+            metrics.increment('nitter_bot_feed_failures_total')
+    end_time = time.perf_counter()
+    last_poll_cycle.update({
+        'finished': time.time(),
+        'feeds': len(feeds),
+        'failed': len(failed_updates),
+        'fetch_seconds': fetch_end_time - start_time,
+        'queue_seconds': end_time - fetch_end_time,
+        'total_seconds': end_time - start_time,
+    })
+    metrics.increment('nitter_bot_poll_cycles_total')
+    metrics.set_gauge('nitter_bot_poll_cycle_seconds', last_poll_cycle['total_seconds'])
+    metrics.set_gauge('nitter_bot_poll_cycle_interval_seconds', SCHEDULER_TICK_SECONDS)
+    metrics.set_gauge('nitter_bot_delivery_queue_depth', delivery_queue.depth())
+    delivery_stats = delivery_queue.stats()
+    logger.info('Poll cycle: feeds=%s failed=%s total=%.2fs fetch=%.2fs queue=%.2fs delivery_depth=%s delivery_channels=%s send_latency=%.0fms',
+        len(feeds), len(failed_updates), last_poll_cycle['total_seconds'], last_poll_cycle['fetch_seconds'], last_poll_cycle['queue_seconds'],
+        delivery_stats['depth'], delivery_stats['active_channels'], delivery_stats['average_send_latency'] * 1000)
+    return successful_updates, failed_updates
+
+# Polling starts straight away from the restored state, while slash commands are synced and
+# instances are re-probed (or discovered, on a first start) in the background.
+# on_ready runs again after reconnects, so the loops are only started once.
+command_sync_task = None
+
 @bot.event
 async def on_ready():
-    print(f'{bot.user} has connected to Discord!')
-    print('Getting last used instance...')
-    await get_instance_from_database()
-    print('Syncing slash commands...')
-    for guild in bot.guilds:
-        await tree.sync(guild = discord.Object(id = guild.id)) #guild = discord.Object(id = GUILD_ID))
-    print('Updating current instance...')
-    async with aiohttp.ClientSession() as session:
-        await update_instance(session)
-    print('Starting auto-feed updates...')
-    auto_update_feeds.start()
-    print('Ready')
+    global command_sync_task
+    logger.info('%s has connected to Discord!', bot.user)
+    if command_sync_task is None:
+        command_sync_task = asyncio.create_task(sync_commands())
+    if POLL_WORKERS > 0:
+        if not follow_shared_state.is_running():
+            logger.info('Polling in %s worker processes', POLL_WORKERS)
+            await get_instance_from_database()
+            follow_shared_state.start()
+        logger.info('Ready')
+        return
+    if not auto_update_feeds.is_running():
+        logger.info('Getting last used instances...')
+        try:
+            await get_instance_from_database()
+            load_state_snapshot()
+        finally:
+            logger.info('Starting instance refresh and auto-feed updates...')
+            refresh_instances.start()
+            auto_update_feeds.start()
+    logger.info('Ready')
 
 # Ping command
 @tree.command(name = 'ping', description = 'Test latency') #, guild = discord.Object(GUILD_ID))
@@ -177,20 +1427,98 @@ async def ping_command(interaction: discord.Interaction):
     try:
         await interaction.response.send_message(f'Pong! ({bot.latency*1000:.0f}ms)')
     except Exception as e:
-        print(f'Error: {e}')
+        logger.exception('Error in ping_command: %s', e)
         await interaction.response.send_message(f'{ERROR_MSG}')
 
 # Get current instances
 @tree.command(name = 'get-instance', description = 'Get the current instance being used') #, guild = discord.Object(GUILD_ID))
 async def get_curr_instances(interaction: discord.Interaction):
     try:
-        if instance_domain == '':
+        if instance_pool.domains() == []:
             message = 'Current instance: none'
         else:
-            message = f'Current instance: <https://{instance_domain}>'
+            message = 'Current instances:'
+            for domain in instance_pool.ranked():
+                stats = instance_pool.stats[domain]
+                message += f"\n<https://{domain}> ({stats['latency']*1000:.0f}ms, {stats['errors']*100:.0f}% errors)"
         await interaction.response.send_message(message)
     except Exception as e:
-        print(f'Error: {e}')
+        logger.exception('Error in get_curr_instances: %s', e)
+        await interaction.response.send_message(f'{ERROR_MSG}')
+
+# Polling statistics of this process, in the form poll workers share through the state store
+def get_poll_summary():
+    stages = {}
+    for stage in ('fetch', 'parse', 'db_update', 'send'):
+        histogram = metrics.get_histogram('nitter_bot_stage_seconds', stage = stage)
+        if histogram is not None and histogram['count'] > 0:
+            stages[stage] = [histogram['sum'], histogram['count']]
+    polls = metrics.get_counters_by_label('nitter_bot_polls_total', 'instance')
+    failures = metrics.get_counters_by_label('nitter_bot_upstream_failures_total', 'instance')
+    new_posts = metrics.get_counters_by_label('nitter_bot_new_posts_total', 'instance')
+    instances = {}
+    for domain in set(polls) | set(failures):
+        histogram = metrics.get_histogram('nitter_bot_upstream_latency_seconds', instance = domain) or {'sum': 0.0, 'count': 0}
+        instances[domain] = {'polls': polls[domain], 'new_posts': new_posts[domain], 'failures': failures[domain], 'latency_sum': histogram['sum'], 'latency_count': histogram['count']}
+    return {'last_poll_cycle': dict(last_poll_cycle), 'stages': stages, 'instances': instances, 'new_posts': sum(new_posts.values()), 'delivery': delivery_queue.stats()}
+
+# Add up the summaries of several poll workers
+def merge_poll_summaries(summaries):
+    stages = {}
+    instances = {}
+    delivery = {'depth': 0, 'active_channels': 0, 'sent_messages': 0, 'sent_posts': 0, 'failed_messages': 0, 'average_send_latency': 0.0}
+    for summary in summaries:
+        for stage, (seconds, count) in summary['stages'].items():
+            totals = stages.setdefault(stage, [0.0, 0])
+            totals[0] += seconds
+            totals[1] += count
+        for domain, stats in summary['instances'].items():
+            totals = instances.setdefault(domain, dict.fromkeys(stats, 0))
+            for key, value in stats.items():
+                totals[key] += value
+        for key in delivery:
+            if key != 'average_send_latency':
+                delivery[key] += summary['delivery'][key]
+        # Weighted by the number of messages each worker sent
+        delivery['average_send_latency'] += summary['delivery']['average_send_latency'] * summary['delivery']['sent_messages']
+    delivery['average_send_latency'] /= max(delivery['sent_messages'], 1)
+    return {'stages': stages, 'instances': instances, 'new_posts': sum(summary['new_posts'] for summary in summaries), 'delivery': delivery}
+
+# Polling statistics, for admins. In sharded mode they come from the summaries the poll workers
+# write to the state store with their heartbeats.
+@tree.command(name = 'stats', description = 'Show polling and delivery statistics') #, guild = discord.Object(GUILD_ID))
+@app_commands.default_permissions(manage_guild = True)
+async def get_stats(interaction: discord.Interaction):
+    try:
+        if POLL_WORKERS > 0:
+            worker_summaries = state_store.get_poll_summaries(POLL_WORKER_TIMEOUT_SECONDS)
+            message = f'Polling runs in {len(worker_summaries)} of {POLL_WORKERS} poll workers.'
+        else:
+            worker_summaries = {None: get_poll_summary()}
+            message = ''
+        for worker_id, summary in worker_summaries.items():
+            poll_cycle = summary['last_poll_cycle']
+            label = '**Last poll cycle**' if worker_id is None else f'**Last poll cycle, worker {worker_id}**'
+            if poll_cycle == {}:
+                message += f'\n{label}: none has run yet'
+            else:
+                message += f"\n{label} (<t:{poll_cycle['finished']:.0f}:R>): {poll_cycle['feeds']} feeds, {poll_cycle['failed']} failed, {poll_cycle['total_seconds']:.2f}s (fetch {poll_cycle['fetch_seconds']:.2f}s, queue {poll_cycle['queue_seconds']:.2f}s)"
+        message += f'\n**Tick interval:** {SCHEDULER_TICK_SECONDS}s'
+        summary = merge_poll_summaries(list(worker_summaries.values()))
+        message += '\n**Average stage time:**'
+        for stage, (seconds, count) in summary['stages'].items():
+            message += f" {stage} {seconds / count * 1000:.1f}ms ({count}),"
+        message = message.rstrip(',')
+        message += '\n**Instances:**'
+        for domain, stats in sorted(summary['instances'].items()):
+            latency = stats['latency_sum'] / stats['latency_count'] * 1000 if stats['latency_count'] > 0 else 0
+            message += f"\n{domain}: {stats['polls']:.0f} polls, {stats['new_posts']:.0f} new posts, {stats['failures']:.0f} failures, {latency:.0f}ms average"
+        delivery_stats = summary['delivery']
+        message += f"\n**Posts:** {summary['new_posts']:.0f} new, {delivery_stats['sent_posts']} delivered in {delivery_stats['sent_messages']} messages, {delivery_stats['failed_messages']} failed messages"
+        message += f"\n**Delivery queue:** {delivery_stats['depth']} posts in {delivery_stats['active_channels']} channels, average send latency {delivery_stats['average_send_latency']*1000:.0f}ms"
+        await interaction.response.send_message(message.strip()[:MESSAGE_MAX_LENGTH])
+    except Exception as e:
+        logger.exception('Error in get_stats: %s', e)
         await interaction.response.send_message(f'{ERROR_MSG}')
 
 # Add feed command
@@ -200,21 +1528,18 @@ async def get_curr_instances(interaction: discord.Interaction):
 async def add_feed(interaction: discord.Interaction, name: str, channel: discord.TextChannel):    
     selected_channel = discord.utils.get(interaction.guild.channels, name = str(channel))
     # Check for duplicates
-    if feeds_db.count(Query()['name'] == name) and feeds_db.count(Query()['channel_id'] == selected_channel.id):
+    if feed_index.get_feed(name.lower(), selected_channel.id) is not None:
         await interaction.response.send_message(f'The feed @{name} has already been added to <#{selected_channel.id}>.')
         return
     # Check if account/link is valid
     try:
         await interaction.response.defer(thinking = True)
-        async with aiohttp.ClientSession() as session:
-            await update_instance(session)
-            #print(f'Adding feed using domain: {instance_domain}')
-            rss = await check_feed_status(name, session)
-            await interaction.followup.send(f'New posts from user **@{name.lower()}** will be sent in <#{selected_channel.id}>.')
-            #timestamp = await get_timestamp_from_datetime(datetime.now())
-            feeds_db.insert({'guild_id':interaction.guild.id, 'name':name.lower(), 'channel_id':selected_channel.id, 'last_checked':-1, 'enabled':True})
+        rss = await check_feed_status(name, http_session)
+        await interaction.followup.send(f'New posts from user **@{name.lower()}** will be sent in <#{selected_channel.id}>.')
+        #timestamp = await get_timestamp_from_datetime(datetime.now())
+        feed_index.add_feed(interaction.guild.id, name.lower(), selected_channel.id)
     except Exception as e:
-        print(f'Error: {e}')
+        logger.exception('Error in add_feed: %s', e)
         #error_msg = await output_error_feed_not_found(name)
         await interaction.followup.send(f'{ERROR_MSG} The feed \'{name}\' could not be added.')
 
@@ -226,10 +1551,10 @@ async def add_feed(interaction: discord.Interaction, name: str, channel: discord
 async def remove_feed(interaction: discord.Interaction, identifier: str):    
     try:
         feed_data = await get_feed_data_from_identifier(identifier)
-        feeds_db.remove((Query()['name'] == feed_data['name']) & (Query()['channel_id'] == feed_data['channel_id']))
+        feed_index.remove_feed(feed_data['name'], feed_data['channel_id'])
         await interaction.response.send_message(f"The feed **@{feed_data['name']}** in <#{feed_data['channel_id']}> has been removed from the list of feeds.")
     except Exception as e:
-        print(f'Error: {e}')
+        logger.exception('Error in remove_feed: %s', e)
         error_msg = await output_error_feed_not_found(name)
         await interaction.followup.send(f'{error_msg}')
 
@@ -241,17 +1566,17 @@ async def remove_feed(interaction: discord.Interaction, identifier: str):
 @app_commands.autocomplete(identifier = feeds_autocomplete)
 async def change_channel(interaction: discord.Interaction, identifier: str, channel: discord.TextChannel):
     try:
-        print(identifier)
+        logger.debug('change_channel identifier=%s', identifier)
         feed_data = await get_feed_data_from_identifier(identifier)
-        print(feed_data)
+        logger.debug('change_channel feed_data=%s', feed_data)
         selected_channel = discord.utils.get(interaction.guild.channels, name = str(channel))
-        if feeds_db.count((Query()['name'] == feed_data['name']) & (Query()['channel_id'] == selected_channel.id)) > 0:
+        if feed_index.get_feed(feed_data['name'], selected_channel.id) is not None:
             await interaction.response.send_message(f"The feed **@{feed_data['name']}** is already in <#{selected_channel.id}>.")
             return
-        feeds_db.update({'channel_id':selected_channel.id}, (Query()['name'] == feed_data['name']) & (Query()['channel_id'] == feed_data['channel_id']))
+        feed_index.update_feed(feed_data['name'], feed_data['channel_id'], {'channel_id': selected_channel.id})
         await interaction.response.send_message(f"New posts from user **@{feed_data['name']}** will now be sent in <#{selected_channel.id}>.")
     except Exception as e:
-        print(f'Error: {e}')
+        logger.exception('Error in change_channel: %s', e)
         error_msg = await output_error_feed_not_found(name)
         await interaction.followup.send(f'{error_msg}')
 
@@ -260,7 +1585,7 @@ async def change_channel(interaction: discord.Interaction, identifier: str, chan
 async def get_feeds(interaction: discord.Interaction):    
     message = ''
     try:
-        feeds = feeds_db.search(Query().guild_id == interaction.guild.id)
+        feeds = feed_index.get_guild_feeds(interaction.guild.id)
         if feeds == []:
             message = 'There are no added feeds.'
         else:
@@ -269,7 +1594,58 @@ async def get_feeds(interaction: discord.Interaction):
                 message += f"\nFeed: **@{feeds[index]['name']}**, Channel: <#{feeds[index]['channel_id']}>"
         await interaction.response.send_message(message)
     except Exception as e:
-        print(f'Error: {e}')
+        logger.exception('Error in get_feeds: %s', e)
+        await interaction.response.send_message(f'{ERROR_MSG}')
+
+# Import feeds command
+@tree.command(name = 'import-feeds', description = 'Add feeds from a text, CSV or OPML file') #, guild = discord.Object(GUILD_ID))
+@app_commands.describe(file = 'File with one username per line, optionally followed by a channel, or an OPML file')
+@app_commands.describe(channel = 'Channel for feeds that have no channel in the file')
+@app_commands.default_permissions(manage_guild = True)
+async def import_feeds(interaction: discord.Interaction, file: discord.Attachment, channel: Optional[discord.TextChannel] = None):
+    try:
+        await interaction.response.defer(thinking = True)
+        if file.size > IMPORT_MAX_FILE_BYTES:
+            await interaction.followup.send(f'{ERROR_MSG} The file is larger than {IMPORT_MAX_FILE_BYTES // 1024} KB.')
+            return
+        entries = parse_import_file((await file.read()).decode('utf-8-sig', errors = 'replace'))
+        if entries == []:
+            await interaction.followup.send(f'{ERROR_MSG} No feeds were found in the file.')
+            return
+        if len(entries) > IMPORT_MAX_FEEDS:
+            await interaction.followup.send(f'{ERROR_MSG} The file has {len(entries)} feeds, the limit is {IMPORT_MAX_FEEDS}.')
+            return
+        added, results = await import_feed_entries(interaction.guild, entries, channel, http_session)
+        summary = f'Imported **{added}** of {len(results)} feeds.'
+        details = '\n'.join(f'@{name}' + (f' in <#{channel_id}>' if channel_id is not None else '') + f': {result}' for name, channel_id, result in results)
+        if len(summary) + len(details) + 1 <= MESSAGE_MAX_LENGTH:
+            await interaction.followup.send(f'{summary}\n{details}')
+        else:
+            # Results for large imports go in a file
+            details = '\n'.join(f'@{name}' + (f' in #{bot.get_channel(channel_id) or channel_id}' if channel_id is not None else '') + f': {result}' for name, channel_id, result in results)
+            await interaction.followup.send(summary, file = discord.File(io.BytesIO(details.encode()), filename = 'import-results.txt'))
+    except Exception as e:
+        logger.exception('Error in import_feeds: %s', e)
+        await interaction.followup.send(f'{ERROR_MSG} The feeds could not be imported.')
+
+# Export feeds command
+@tree.command(name = 'export-feeds', description = 'Export the feeds in the server as a CSV file') #, guild = discord.Object(GUILD_ID))
+async def export_feeds(interaction: discord.Interaction):
+    try:
+        feeds = feed_index.get_guild_feeds(interaction.guild.id)
+        if feeds == []:
+            await interaction.response.send_message('There are no added feeds.')
+            return
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(['name', 'channel_id', 'channel', 'enabled'])
+        for feed_data in feeds:
+            channel = bot.get_channel(feed_data['channel_id'])
+            writer.writerow([feed_data['name'], feed_data['channel_id'], channel.name if channel is not None else '', str(feed_data['enabled']).lower()])
+        file = discord.File(io.BytesIO(output.getvalue().encode()), filename = 'feeds.csv')
+        await interaction.response.send_message(f'Exported {len(feeds)} feeds.', file = file)
+    except Exception as e:
+        logger.exception('Error in export_feeds: %s', e)
         await interaction.response.send_message(f'{ERROR_MSG}')
 
 # Enable feed
@@ -284,10 +1660,10 @@ async def enable_feed(interaction: discord.Interaction, identifier: str):
         if feed_data['enabled'] == True:
             await interaction.followup.send(f"The feed @{feed_data['name']} is already enabled.")
             return
-        feeds_db.update({'enabled': True}, (Query()['name'] == feed_data['name']) & (Query()['channel_id'] == feed_data['channel_id']))
+        feed_index.update_feed(feed_data['name'], feed_data['channel_id'], {'enabled': True})
         await interaction.followup.send(f"The feed has been enabled. New posts from **@{feed_data['name']}** will now be sent in <#{feed_data['channel_id']}>.")
     except Exception as e:
-        print(f'Error: {e}')
+        logger.exception('Error in enable_feed: %s', e)
         await interaction.followup.send(f'{ERROR_MSG}')
 
 # Disable feed
@@ -302,15 +1678,15 @@ async def disable_feed(interaction: discord.Interaction, identifier: str):
         if feed_data['enabled'] == False:
             await interaction.followup.send(f"The feed @{feed_data['name']} is already disabled.")
             return
-        feeds_db.update({'enabled': False}, (Query()['name'] == feed_data['name']) & (Query()['channel_id'] == feed_data['channel_id']))
+        feed_index.update_feed(feed_data['name'], feed_data['channel_id'], {'enabled': False})
         await interaction.followup.send(f"The feed has been disabled. New posts from **@{feed_data['name']}** will no longer be sent in <#{feed_data['channel_id']}>.")
     except Exception as e:
-        print(f'Error: {e}')
+        logger.exception('Error in disable_feed: %s', e)
         await interaction.followup.send(f'{ERROR_MSG}')
 
 # Reload feed
-# Nitter feeds don't use ETag or last modified
-# Compare using Unix timestamp
+# Most Nitter instances don't send ETag or Last-Modified, so get_rss_feed also compares the body
+# hash and newest post ID. New posts are the ones before the first status ID the feed has already seen.
 @tree.command(name = 'update-feed', description = 'Refresh a feed and check for new posts') #, guild = discord.Object(GUILD_ID))
 @app_commands.describe(identifier = 'Feed to update')
 @app_commands.autocomplete(identifier = feeds_autocomplete)
@@ -322,16 +1698,16 @@ async def update_feed(interaction: discord.Interaction, identifier: str):
         if feed_data['enabled'] == False:
             await interaction.followup.send(f"The feed @{feed_data['name']} is currently disabled. To reload, enable the feed first.")
             return
-        channel = bot.get_channel(feed_data['channel_id'])
-        async with aiohttp.ClientSession() as session:
-            await update_instance(session)
-            rss = await get_rss_feed(feed_data['name'], session)
-            posts = await get_latest_posts(feed_data, rss, session)
-            for post in posts:
-                timestamp = await get_display_timestamp(post.published_parsed)
-                link = await get_display_link(post.link)
-                await channel.send(f'**{rss.feed.title}** ({timestamp}):\n{link}')
-        message = f"Updated feed **@{feed_data['name']}** in <#{channel.id}>."
+        if POLL_WORKERS > 0:
+            state_store.request_refresh([feed_data['name']])
+            await interaction.followup.send(f"Requested an update of feed **@{feed_data['name']}**. New posts will be sent in <#{feed_data['channel_id']}> within {SCHEDULER_TICK_SECONDS} seconds.")
+            return
+        domain, rss = await get_rss_feed(feed_data['name'], http_session, get_parse_stop_ids([feed_data]))
+        posts = await get_latest_posts(feed_data, rss, http_session)
+        feed_index.flush()
+        await send_posts(feed_data['channel_id'], rss, posts)
+        metrics.increment('nitter_bot_new_posts_total', len(posts), instance = domain)
+        message = f"Updated feed **@{feed_data['name']}** in <#{feed_data['channel_id']}>."
         if posts == []:
             message += ' No new posts since the last update.'
         elif len(posts) == 1:
@@ -340,7 +1716,7 @@ async def update_feed(interaction: discord.Interaction, identifier: str):
             message += f" There are {len(posts)} new posts since the last update."
         await interaction.followup.send(message)
     except Exception as e:
-        print(f'Error: {e}')
+        logger.exception('Error in update_feed: %s', e)
         await interaction.followup.send(f'{ERROR_MSG} The feed could not be reloaded.')
 
 # Last post command
@@ -350,15 +1726,13 @@ async def update_feed(interaction: discord.Interaction, identifier: str):
 async def get_last_post(interaction: discord.Interaction, feed: str):
     try:
         await interaction.response.defer(thinking = True)
-        async with aiohttp.ClientSession() as session:
-            await update_instance(session)
-            rss = await get_rss_feed(feed, session)
-            post = rss.entries[0]
-            timestamp = await get_display_timestamp(post.published_parsed)
-            link = await get_display_link(post.link)
-            await interaction.followup.send(f'Latest post from **{rss.feed.title}** ({timestamp}):\n{link}')
+        domain, rss = await get_rss_feed(feed, http_session, newest_only = True)
+        post_timestamp, post_link, post_id = rss.entries[0]
+        timestamp = await get_display_timestamp(post_timestamp)
+        link = await get_display_link(post_link)
+        await interaction.followup.send(f'Latest post from **{rss.title}** ({timestamp}):\n{link}')
     except Exception as e:
-        print(f'Error: {e}')
+        logger.exception('Error in get_last_post: %s', e)
         error_msg = await output_error_feed_not_found(feed)
         await interaction.followup.send(f'{error_msg}')
 
@@ -370,29 +1744,16 @@ async def manually_update_all_feeds(interaction: discord.Interaction):
         successful_updates = []
         failed_updates = []
         await interaction.response.defer(thinking=True)
-        async with aiohttp.ClientSession() as session:
-            await update_instance(session)
-            feeds = feeds_db.search(Query().guild_id == interaction.guild.id)
-            if feeds == []:
-                message = 'There are no feeds to update! Add a feed to get started.'
-            else:
-                for index in range(len(feeds)):
-                    try:
-                        if feeds[index]['enabled'] == False:
-                            continue
-                        channel = bot.get_channel(feeds[index]['channel_id'])
-                        rss = await get_rss_feed(feeds[index]['name'], session)
-                        posts = await get_latest_posts(feeds[index], rss, session)
-                        number_of_posts = 0
-                        for post in posts:
-                            timestamp = await get_display_timestamp(post.published_parsed)
-                            link = await get_display_link(post.link)
-                            await channel.send(f'**{rss.feed.title}** ({timestamp}):\n{link}')
-                            number_of_posts += 1
-                        successful_updates.append({'name': feeds[index]['name'], 'channel_id': feeds[index]['channel_id'], 'posts': number_of_posts})
-                    except Exception as e:
-                        print(f'Error: {e}')
-                        failed_updates.append({'name': feeds[index]['name'], 'channel_id': feeds[index]['channel_id']})
+        feeds = feed_index.get_guild_feeds(interaction.guild.id)
+        if feeds == []:
+            message = 'There are no feeds to update! Add a feed to get started.'
+        else:
+            enabled_feeds = [feed_data for feed_data in feeds if feed_data['enabled']]
+            if POLL_WORKERS > 0:
+                state_store.request_refresh(list({feed_data['name'] for feed_data in enabled_feeds}))
+                await interaction.followup.send(f'Requested an update of {len(enabled_feeds)} feeds. New posts will be sent within {SCHEDULER_TICK_SECONDS} seconds.')
+                return
+            successful_updates, failed_updates = await poll_feeds(enabled_feeds, http_session)
         # Print summary
         if successful_updates != []:
             message += ':green_circle: Successfully updated feeds:'
@@ -406,42 +1767,128 @@ async def manually_update_all_feeds(interaction: discord.Interaction):
                 message += f"\nFeed: **@{item['name']}**, Channel: <#{item['channel_id']}>"
         await interaction.followup.send(message)
     except Exception as e:
-        print(f'Error: {e}')
+        logger.exception('Error in manually_update_all_feeds: %s', e)
         await interaction.followup.send(f'{ERROR_MSG}')
 
+# In sharded mode manual refreshes are handed to the poll worker that owns the username, so only one
+# process polls it and sends its posts. The worker makes requested usernames due on its next tick.
+def take_refresh_requests(subscriptions: dict):
+    requested_names = [name for name in state_store.get_refresh_requests() if name in subscriptions]
+    if requested_names == []:
+        return
+    now = time.time()
+    for name in requested_names:
+        feed_scheduler.push(name, now)
+    state_store.clear_refresh_requests(requested_names)
+    logger.info('Refreshing %s usernames on request', len(requested_names))
+
 # Automatically update all feeds
-# Nitter RSS feed updates at interval of 15 minutes (900 seconds)
-@tasks.loop(minutes = FEED_REFRESH_INTERVAL_MINUTES)
+# Each tick polls the feeds the scheduler has marked as due
+@tasks.loop(seconds = SCHEDULER_TICK_SECONDS)
 async def auto_update_feeds():
+    global first_poll_seconds
     try:
-        #failed_updates = []
-        #message = ''
-        async with aiohttp.ClientSession() as session:
-            await update_instance(session)
-            for guild in bot.guilds:
-                feeds = feeds_db.search(Query().guild_id == guild.id)
-                for index in range(len(feeds)):
-                    try:
-                        if feeds[index]['enabled'] == False or int(datetime.timestamp(datetime.now())) - feeds[index]['last_checked'] < (FEED_REFRESH_INTERVAL_MINUTES - 1) * 60:
-                            print(f"Skipping {feeds[index]['name']} in {guild.name} at {time.ctime()}")
-                            continue
-                        print(f"Checking {feeds[index]['name']} in {guild.name} at {time.ctime()}")
-                        channel = bot.get_channel(feeds[index]['channel_id'])
-                        rss = await get_rss_feed(feeds[index]['name'], session)
-                        posts = await get_latest_posts(feeds[index], rss, session)
-                        for post in posts:
-                            timestamp = await get_display_timestamp(post.published_parsed)
-                            link = await get_display_link(post.link)
-                            await channel.send(f'**{rss.feed.title}** ({timestamp}):\n{link}')
-                    except Exception as e:
-                        print(f'Error: {e}')
-                        #failed_updates.append({'name': feeds[index]['name'], 'channel_id': feeds[index]['channel_id']})
-                        #if failed_updates != []:
-                        #    message += ':o: Failed to update feeds:'
-                        #    for item in failed_updates:
-                        #        message += f"\nFeed: **@{item['name']}**, Channel: <#{item['channel_id']}>"
+        if poll_worker_id is not None:
+            await load_shared_state()
+        # On a first start there are no instances until discovery finishes
+        if instance_pool.domains() == []:
+            return
+        subscriptions = {}
+        for feed_data in get_polled_feeds():
+            if feed_data['enabled'] and owns_feed(feed_data['name']):
+                subscriptions.setdefault(feed_data['name'], []).append(feed_data)
+        feed_scheduler.sync(set(subscriptions))
+        if poll_worker_id is not None:
+            take_refresh_requests(subscriptions)
+        due_names = feed_scheduler.pop_due(time.time())
+        if due_names == []:
+            return
+        logger.debug('Checking %s due feeds', len(due_names))
+        due_feeds = [feed_data for name in due_names for feed_data in subscriptions[name]]
+        await poll_feeds(due_feeds, http_session)
+        if first_poll_seconds is None:
+            first_poll_seconds = time.time() - process_start_time
+            metrics.set_gauge('nitter_bot_time_to_first_poll_seconds', first_poll_seconds)
+            logger.info('Time to first poll: %.2fs', first_poll_seconds)
     except Exception as e:
-        print(f'Error: {e}')
+        logger.exception('Error in auto_update_feeds: %s', e)
+
+# Re-probe instances in the background instead of before every command. While the pool is
+# empty (discovery failed on a first start), retry soon with a backoff instead of waiting a full interval.
+instance_retry_seconds = None
+
+@tasks.loop(minutes = INSTANCE_REFRESH_INTERVAL_MINUTES)
+async def refresh_instances():
+    global instance_retry_seconds
+    try:
+        if is_instance_leader():
+            await refresh_instance_pool(http_session)
+    except Exception as e:
+        logger.exception('Error in refresh_instances: %s', e)
+    if is_instance_leader() and instance_pool.domains() == []:
+        instance_retry_seconds = min(instance_retry_seconds * 2 if instance_retry_seconds else INSTANCE_RETRY_SECONDS, INSTANCE_REFRESH_INTERVAL_MINUTES * 60)
+        logger.warning('No instances available, retrying in %ss', instance_retry_seconds)
+        refresh_instances.change_interval(seconds = instance_retry_seconds)
+    elif instance_retry_seconds is not None:
+        instance_retry_seconds = None
+        refresh_instances.change_interval(minutes = INSTANCE_REFRESH_INTERVAL_MINUTES)
+
+# Poll workers send heartbeats on their own loop, so a poll cycle that runs longer than
+# POLL_WORKER_TIMEOUT_SECONDS doesn't make the other workers take over its usernames mid-cycle.
+# Each heartbeat also shares the worker's polling statistics with /stats in the bot process.
+@tasks.loop(seconds = POLL_WORKER_HEARTBEAT_SECONDS)
+async def send_heartbeats():
+    try:
+        update_poll_worker_membership()
+        state_store.set_poll_summary(poll_worker_id, get_poll_summary())
+    except Exception as e:
+        logger.exception('Error in send_heartbeats: %s', e)
+
+# In sharded mode the bot process follows the feeds and instances kept up to date by the workers
+@tasks.loop(seconds = SCHEDULER_TICK_SECONDS)
+async def follow_shared_state():
+    try:
+        await load_shared_state()
+    except Exception as e:
+        logger.exception('Error in follow_shared_state: %s', e)
+
+# Poll worker process: sends posts through the Discord REST API only, without a gateway connection
+async def run_poll_worker(worker_id: str):
+    global poll_worker_id, METRICS_PORT, STATE_SNAPSHOT_PATH
+    poll_worker_id = worker_id
+    if METRICS_PORT != 0:
+        METRICS_PORT += 1 + int(worker_id)
+    snapshot_root, snapshot_extension = os.path.splitext(STATE_SNAPSHOT_PATH)
+    STATE_SNAPSHOT_PATH = f'{snapshot_root}-worker-{worker_id}{snapshot_extension}'
+    async with bot:
+        await bot.login(DISCORD_TOKEN)
+        update_poll_worker_membership()
+        await get_instance_from_database()
+        load_state_snapshot()
+        logger.info('Poll worker %s started, live workers: %s', worker_id, ', '.join(live_poll_workers))
+        send_heartbeats.start()
+        refresh_instances.start()
+        auto_update_feeds.start()
+        while not bot.is_closed():
+            await asyncio.sleep(1)
+
+def start_poll_workers():
+    workers = [subprocess.Popen([sys.executable, os.path.abspath(__file__), '--poll-worker', str(index)]) for index in range(POLL_WORKERS)]
+    atexit.register(lambda: [worker.terminate() for worker in workers])
+    return workers
 
 # Executes the bot with the specified token.
-bot.run(DISCORD_TOKEN, log_handler = handler)
+if __name__ == '__main__':
+    log_level = logging.getLevelName(LOG_LEVEL.upper())
+    if len(sys.argv) == 3 and sys.argv[1] == '--poll-worker':
+        worker_handler = logging.FileHandler(filename = f'discord-worker-{sys.argv[2]}.log', encoding = 'utf-8', mode = 'w')
+        discord.utils.setup_logging(handler = worker_handler, level = log_level, root = True)
+        open_storage(FEEDS_DB_PATH)
+        asyncio.run(run_poll_worker(sys.argv[2]))
+    else:
+        # Logging is set up here rather than by bot.run so the migration is logged too
+        discord.utils.setup_logging(handler = handler, level = log_level, root = True)
+        open_storage(FEEDS_DB_PATH, migrate = True)
+        if POLL_WORKERS > 0:
+            start_poll_workers()
+        bot.run(DISCORD_TOKEN, log_handler = None)
@@ -0,0 +1,55 @@
+# Nitter RSS parsing, kept apart from main.py so the parse pool's worker processes only need this
+# module and the standard library. Importing it has no side effects.
+import io
+import re
+import time
+import calendar
+import email.utils
+import feedparser
+import xml.etree.ElementTree as ElementTree
+
+STATUS_ID_PATTERN = re.compile(r'/status/(\d+)') # Status ID in a post link
+
+# Status ID of a post, taken from its link. Falls back to the whole link for links without one.
+def get_post_id(link: str):
+    match = STATUS_ID_PATTERN.search(link)
+    return match.group(1) if match else link
+
+# Parse only the link and publish date of each item, stopping after the first item whose status ID
+# is in stop_ids. Returns the feed title, (timestamp, link, status ID) for each post, newest first,
+# and whether the whole feed was parsed. Raises ElementTree.ParseError on malformed feeds.
+def parse_rss_fast(body: bytes, stop_ids = None):
+    title = None
+    entries = []
+    for event, element in ElementTree.iterparse(io.BytesIO(body), events = ('end',)):
+        if element.tag == 'item':
+            timestamp = email.utils.mktime_tz(email.utils.parsedate_tz(element.findtext('pubDate')))
+            link = element.findtext('link')
+            post_id = get_post_id(link)
+            entries.append((timestamp, link, post_id))
+            element.clear()
+            if stop_ids is not None and post_id in stop_ids:
+                return title, entries, False
+        elif element.tag == 'title' and title is None:
+            # The channel title comes before any item or image title
+            title = element.text or ''
+    if title is None:
+        raise ElementTree.ParseError('No channel title found')
+    return title, entries, True
+
+# Parse a whole feed with feedparser. Nitter dates are in UTC, so timestamps come from calendar.timegm.
+def parse_rss_feedparser(body: bytes):
+    rss = feedparser.parse(body)
+    entries = [(calendar.timegm(entry.published_parsed), entry.link, get_post_id(entry.link)) for entry in rss.entries]
+    return rss.feed.get('title', ''), entries, True
+
+# Parse a feed with the fast parser, falling back to feedparser for feeds it can't handle.
+# Runs in the parse executor. Returns the parsed feed, the fast parser error if the fallback was used
+# and the time spent parsing, which leaves out time spent waiting for a free worker.
+def parse_rss_feed(body: bytes, stop_ids = None):
+    start_time = time.perf_counter()
+    try:
+        result, error = parse_rss_fast(body, stop_ids), None
+    except Exception as e:
+        result, error = parse_rss_feedparser(body), str(e)
+    return result, error, time.perf_counter() - start_time